@@ -0,0 +1,143 @@
+import numpy as np
+
+
+class RingBuffer:
+    def __init__(self, capacity, channels):
+        self.capacity = capacity
+        self.t = np.empty(capacity, dtype=np.float64)
+        self.y = np.empty((channels, capacity), dtype=np.float64)
+        self.start = 0
+        self.size = 0
+
+    def clear(self):
+        self.start = 0
+        self.size = 0
+
+    def extend(self, tt, ys):
+        if len(tt) > self.capacity:
+            tt = tt[-self.capacity:]
+            ys = ys[:, -self.capacity:]
+        k = len(tt)
+        end = (self.start + self.size) % self.capacity
+        first = min(k, self.capacity - end)
+        self.t[end:end + first] = tt[:first]
+        self.y[:, end:end + first] = ys[:, :first]
+        self.t[:k - first] = tt[first:]
+        self.y[:, :k - first] = ys[:, first:]
+        overflow = max(self.size + k - self.capacity, 0)
+        self.start = (self.start + overflow) % self.capacity
+        self.size += k - overflow
+
+    # Samples with t0 <= t <= t1 in chronological order.  The stored samples
+    # form at most two sorted runs, so this costs O(log n + window).
+    def window(self, t0, t1):
+        end = self.start + self.size
+        runs = [(self.start, min(end, self.capacity)), (0, max(end - self.capacity, 0))]
+        ts = []
+        ys = []
+        for lo, hi in runs:
+            i = lo + np.searchsorted(self.t[lo:hi], t0, side='left')
+            j = lo + np.searchsorted(self.t[lo:hi], t1, side='right')
+            ts.append(self.t[i:j])
+            ys.append(self.y[:, i:j])
+        return np.concatenate(ts), np.concatenate(ys, axis=1)
+
+    def last_time(self):
+        return self.t[(self.start + self.size - 1) % self.capacity]
+
+
+# Reduce each trace to the min and max of every bucket of consecutive samples,
+# which preserves the visible envelope when there are many samples per pixel.
+def minmax_decimate(tt, ys, buckets):
+    n = len(tt)
+    if n <= 2 * buckets:
+        return tt, ys
+    size = -(-n // buckets)
+    buckets = -(-n // size)
+    pad = buckets * size - n
+    ys = np.pad(ys, ((0, 0), (0, pad)), mode='edge').reshape(ys.shape[0], buckets, size)
+    out_t = np.repeat(tt[::size], 2)
+    out_y = np.empty((ys.shape[0], 2 * buckets), dtype=ys.dtype)
+    out_y[:, 0::2] = ys.min(axis=2)
+    out_y[:, 1::2] = ys.max(axis=2)
+    return out_t, out_y
+
+
+# Sweep-mode oscilloscope: the x axis shows one fixed page of `span` seconds
+# and jumps to the next page when the trace reaches its right edge, like a
+# hardware scope.  Within a page only the line artists are redrawn (blitted
+# over a cached background); the full figure is drawn only on page flips,
+# y-range growth or resize.  Traces are min/max decimated to the pixel width
+# of the axes; zooming re-reads the full-resolution samples of the visible
+# window from the ring buffer.
+class Scope:
+    def __init__(self, figure, legends, span, capacity):
+        self.figure = figure
+        self.canvas = figure.canvas
+        self.span = span
+        self.buffer = RingBuffer(capacity, len(legends))
+        self.ax = figure.add_subplot()
+        self.lines = [self.ax.plot([], [], animated=True)[0] for legend in legends]
+        self.time_text = self.ax.text(0.02, 0.95, '', transform=self.ax.transAxes, animated=True)
+        if legends:
+            self.ax.legend(self.lines, legends, loc='upper right')
+        self.page = 0
+        self.ax.set_xlim(0, span)
+        self.ax.set_ylim(-1, 1)
+        self.background = None
+        self.paging = False
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        self.ax.callbacks.connect('xlim_changed', self.on_zoom)
+
+    def append(self, tt, ys):
+        self.buffer.extend(tt, ys)
+
+    def on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self.draw_artists()
+
+    def on_zoom(self, ax):
+        if not self.paging:
+            self.update_lines()
+
+    def update_lines(self):
+        t0, t1 = self.ax.get_xlim()
+        tt, ys = self.buffer.window(t0, t1)
+        tt, ys = minmax_decimate(tt, ys, max(int(self.ax.bbox.width), 1))
+        for line, y in zip(self.lines, ys):
+            line.set_data(tt, y)
+        return ys
+
+    def draw_artists(self):
+        for line in self.lines:
+            self.ax.draw_artist(line)
+        self.ax.draw_artist(self.time_text)
+
+    def redraw(self):
+        if self.buffer.size == 0:
+            return
+        t_last = self.buffer.last_time()
+        page = int(t_last // self.span)
+        full = self.background is None or page != self.page
+        if page != self.page:
+            self.page = page
+            self.paging = True
+            self.ax.set_xlim(page * self.span, (page + 1) * self.span)
+            self.paging = False
+        ys = self.update_lines()
+        self.time_text.set_text('time = %f' % t_last)
+
+        if ys.size:
+            y_min, y_max = ys.min(), ys.max()
+            low, high = self.ax.get_ylim()
+            if y_min < low or y_max > high:
+                margin = 0.1 * max(y_max - y_min, 1e-12)
+                self.ax.set_ylim(min(low, y_min - margin), max(high, y_max + margin))
+                full = True
+
+        if full or not self.canvas.supports_blit:
+            self.canvas.draw_idle()
+        else:
+            self.canvas.restore_region(self.background)
+            self.draw_artists()
+            self.canvas.blit(self.figure.bbox)
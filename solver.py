@@ -1,4 +1,5 @@
 import numpy as np
+from scipy.linalg import lu_factor, lu_solve
 from dataclasses import dataclass
 import re
 import sys
@@ -197,7 +198,7 @@ def solve():
     print('b:')
     print(b)
 
-    inv_A = np.linalg.inv(A)
+    lu = lu_factor(A)
 
     t = 0
     delta_t = 1e-5
@@ -209,7 +210,7 @@ def solve():
     plt.pause(0.001)
     tic = time.time()
     while t < 1:
-        x = inv_A.dot(b)
+        x = lu_solve(lu, b)
         tt.append(t)
         seq.append(x[2])
         print(t, x[2])
@@ -1,9 +1,20 @@
 import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.linalg import splu
+from scipy.linalg import lu_factor, lu_solve, get_lapack_funcs
+from array import array
 from dataclasses import dataclass
+import argparse
+import ast
+import hashlib
+import os
 import re
 import sys
-import matplotlib
-matplotlib.use('Qt5Agg')
+import tempfile
+import time
+import zipfile
+
+from waveform import WaveformWriter
 
 
 @dataclass
@@ -22,236 +33,1890 @@ class Component:
         return (self.type + str(self.nid)) == (other.type + str(other.nid))
 
 
+# Element types in the order of their type codes
+TYPES = ('R', 'VS', 'CS', 'C', 'L', 'AC', 'VCVS', 'VCCS', 'CCVS', 'CCCS', 'D', 'M', 'SW')
+TYPE_CODE = {_type: code for code, _type in enumerate(TYPES)}
+# Nonlinear devices, which have no branch row and are solved by Newton
+DEVICE_TYPES = ['D', 'M', 'SW']
+
+NAME_RE = re.compile(r'([A-Z]+)([0-9]+)$')
+
+
+# An element name such as 'R12' as one integer, nid * len(TYPES) + type code
+def name_key(name):
+    match = NAME_RE.match(name)
+    if not match or match.group(1) not in TYPE_CODE:
+        raise KeyError(name)
+    return int(match.group(2)) * len(TYPES) + TYPE_CODE[match.group(1)]
+
+
+def key_name(key):
+    return TYPES[key % len(TYPES)] + str(key // len(TYPES))
+
+
+# Columns of the registry and of a parsed Netlist.  ref is the key of the
+# controlling element of a CCVS/CCCS and -1 otherwise.
+COLUMNS = {
+    'type': np.int8,
+    'nid': np.int64,
+    'u': np.int64,
+    'v': np.int64,
+    'val': np.float64,
+    'factor': np.float64,
+    'ref_u': np.int64,
+    'ref_v': np.int64,
+    'ref': np.int64,
+}
+
+
+def _column(name):
+    return property(lambda self: self.columns[name][:self.size])
+
+
+# Elements stored as a struct of arrays: row k of every column describes the
+# k-th element, so a million elements cost a few tens of MB and assembly
+# works on whole columns.  Columns grow geometrically.  Names are looked up
+# through a sorted array of keys that is rebuilt lazily; rows appended since
+# the last rebuild are searched directly.
 class ComponentRegistry:
+    type = _column('type')
+    nid = _column('nid')
+    u = _column('u')
+    v = _column('v')
+    val = _column('val')
+    factor = _column('factor')
+    ref_u = _column('ref_u')
+    ref_v = _column('ref_v')
+    ref = _column('ref')
+
     def __init__(self) -> object:
-        self.comps = []
-        self.name_to_comps = {}
-        self.inv_A = []
-        self.b = []
-        self.current_note = {}
-        self.dynamic_place = {}
+        self.clear()
 
     def clear(self):
-        self.comps = []
-        self.name_to_comps = {}
-        self.inv_A = []
+        self.columns = {name: np.empty(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+        self.size = 0
+        self.sorted_keys = None
+        self.sorted_rows = None
+        self.indexed = 0
+        self.A = None
+        self.solver = None
+        # Factorizations of the step matrices per (step, method), kept across
+        # simulations of the same circuit, and the column order of their
+        # (shared) pattern, kept across value changes
+        self.solvers = {}
+        self.step_order = None
+        # Cache file the registry was loaded from, if any
+        self.cache = None
+        self.stamps = None
+        # Absolute path of the netlist file the registry was loaded from
+        self.source = None
         self.b = []
-        self.current_note = {}
-        self.dynamic_place = {}
+        # Branch row of every element, -1 for resistors; set by solve()
+        self.branch = np.empty(0, dtype=np.int64)
 
     def getN(self):
-        n = 0
-        for comp in self.comps:
-            n = max(n, comp.u)
-            n = max(n, comp.v)
-        return n + 1
+        if self.size == 0:
+            return 1
+        return int(max(self.u.max(), self.v.max(), self.ref_u.max(), self.ref_v.max())) + 1
 
     def getM(self):
-        return len(self.comps)
+        return self.size
+
+    def keys(self):
+        return self.nid * len(TYPES) + self.type
+
+    def reserve(self, size):
+        capacity = len(self.columns['type'])
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity, 16)
+        for name, column in self.columns.items():
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            self.columns[name] = grown
+
+    # Row of the element with the given key, or -1
+    def find(self, key):
+        if self.sorted_keys is None or self.size - self.indexed > max(1024, self.indexed):
+            keys = self.keys()
+            self.sorted_rows = np.argsort(keys, kind='stable')
+            self.sorted_keys = keys[self.sorted_rows]
+            self.indexed = self.size
+        k = np.searchsorted(self.sorted_keys, key)
+        if k < len(self.sorted_keys) and self.sorted_keys[k] == key:
+            return int(self.sorted_rows[k])
+        tail = np.flatnonzero(self.keys()[self.indexed:] == key)
+        return self.indexed + int(tail[0]) if len(tail) else -1
+
+    # Rows of the elements with the given keys, -1 where there is none
+    def rows(self, keys):
+        if self.size == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        order = np.argsort(self.keys(), kind='stable')
+        sorted_keys = self.keys()[order]
+        pos = np.minimum(np.searchsorted(sorted_keys, keys), self.size - 1)
+        return np.where(sorted_keys[pos] == keys, order[pos], -1)
+
+    def index(self, name):
+        row = self.find(name_key(name))
+        if row < 0:
+            raise KeyError(name)
+        return row
 
     def has_component(self, name):
-        return name in self.name_to_comps.keys()
+        try:
+            return self.find(name_key(name)) >= 0
+        except KeyError:
+            return False
 
+    def component(self, row):
+        ref = int(self.ref[row])
+        return Component(TYPES[self.type[row]], int(self.nid[row]), int(self.u[row]), int(self.v[row]),
+                         float(self.val[row]), float(self.factor[row]), int(self.ref_u[row]), int(self.ref_v[row]),
+                         key_name(ref) if ref >= 0 else '')
+
+    # A copy of the element; change values through the columns, e.g.
+    # reg.val[reg.index(name)] = value
     def get_component(self, name):
-        return self.name_to_comps[name]
+        return self.component(self.index(name))
+
+    def components(self):
+        for row in range(self.size):
+            yield self.component(row)
 
     def add_component(self, comp: Component):
         name = comp.type + str(comp.nid)
         if self.has_component(name):
             return False
 
-        self.comps.append(comp)
-        self.name_to_comps[name] = comp
+        self.reserve(self.size + 1)
+        row = (TYPE_CODE[comp.type], comp.nid, comp.u, comp.v, comp.val, comp.factor, comp.ref_u, comp.ref_v,
+               name_key(comp.ref_comp) if comp.ref_comp else -1)
+        for column, value in zip(self.columns.values(), row):
+            column[self.size] = value
+        self.size += 1
+        self.stamps = None
         return True
 
+    # Append every element of a parsed Netlist; names must be new
+    def extend(self, netlist):
+        self.reserve(self.size + len(netlist))
+        for name, column in self.columns.items():
+            column[self.size:self.size + len(netlist)] = getattr(netlist, name)
+        self.size += len(netlist)
+        self.stamps = None
+
     def del_component(self, comp: Component):
-        name = comp.type + comp.nid
+        name = comp.type + str(comp.nid)
         if not self.has_component(name):
             return False
 
-        self.comps.remove(comp)
-        del self.name_to_comps[name]
+        row = self.index(name)
+        for column in self.columns.values():
+            column[row:self.size - 1] = column[row + 1:self.size]
+        self.size -= 1
+        self.sorted_keys = None
+        self.stamps = None
         return True
 
-    def forward(self, u: int):
-        for comp in self.comps:
-            if comp.u == u:
-                yield comp
 
-    def backward(self, v: int):
-        for comp in self.comps:
-            if comp.v == v:
-                yield comp
+# Systems with more equations than this are factorized as sparse matrices
+DENSE_LIMIT = 200
+# Changed matrix columns that Solver.update folds into the existing factors
+# before it refactorizes
+LOW_RANK_LIMIT = 8
 
 
 class Solver:
-    def __init__(self, registry):
-        self.reg = reg
+    def __init__(self, A, sparse=None, col_order=None):
+        if sparse is None:
+            sparse = A.shape[0] > DENSE_LIMIT
+        self.sparse = sparse
+        self.x = np.zeros(A.shape[0], dtype=np.float64)
+        self.factorize(A, col_order)
+
+    # A sparse factorization reuses the fill-reducing column order col_order
+    # of an earlier factorization with the same pattern when given one, which
+    # skips the symbolic (ordering) phase of SuperLU.  The solver only takes
+    # over A once it has been factorized, so a singular A raises LinAlgError
+    # and leaves the previous factorization in place.
+    def factorize(self, A, col_order=None):
+        if self.sparse:
+            A = A.tocsc()
+            permuted = col_order is not None
+            try:
+                if permuted:
+                    lu = splu(A[:, col_order], permc_spec='NATURAL')
+                else:
+                    lu = splu(A)
+                    col_order = np.argsort(lu.perm_c)
+            except RuntimeError as e:
+                raise np.linalg.LinAlgError(str(e)) from None
+            self.col_order = col_order
+            self.permuted = permuted
+        else:
+            A = A.toarray()
+            lu, piv = lu_factor(A)
+            if not np.all(np.diag(lu)):
+                raise np.linalg.LinAlgError('Singular matrix')
+            self.piv = piv
+            self.getrs, = get_lapack_funcs(('getrs',), (lu,))
+            self.permuted = False
+        self.A = A
+        self.lu = lu
+        self.low_rank = None
+
+    # Numeric refactorization of a matrix with the same pattern
+    def refactor(self, A):
+        self.factorize(A, self.col_order if self.sparse else None)
+
+    # Switch to the matrix A, which differs from the factorized one only in
+    # values.  While the difference D is confined to a few columns, the
+    # factors are kept and solves are corrected by the Woodbury identity
+    #   (A0 + D)^-1 b = y - Z (I + Z[cols])^-1 y[cols],   y = A0^-1 b,
+    # with cols the changed columns and Z = A0^-1 D[:, cols]; otherwise the
+    # matrix is refactorized on the same pattern.
+    def update(self, A):
+        delta = sp.csc_matrix(A - self.A)
+        delta.eliminate_zeros()
+        cols = np.flatnonzero(np.diff(delta.indptr))
+        if len(cols) > LOW_RANK_LIMIT:
+            self.refactor(A)
+            return
+        low_rank = self.low_rank
+        self.low_rank = None
+        if len(cols) == 0:
+            return
+        Z = self.solve_matrix(delta[:, cols].toarray())
+        lu, piv = lu_factor(np.eye(len(cols)) + Z[cols], check_finite=False)
+        if np.all(np.diag(lu)):
+            self.low_rank = cols, Z, (lu, piv)
+            return
+        self.low_rank = low_rank
+        self.refactor(A)
+
+    def correct(self, y):
+        if self.low_rank is not None:
+            cols, Z, lu = self.low_rank
+            y -= Z @ lu_solve(lu, y[cols], check_finite=False)
+        return y
+
+    # Solve for several right-hand sides (the columns of B) at once
+    def solve_matrix(self, B):
+        if self.sparse:
+            Y = self.lu.solve(np.asarray(B, dtype=np.float64))
+            if not self.permuted:
+                return self.correct(Y)
+            X = np.empty_like(Y)
+            X[self.col_order] = Y
+            return self.correct(X)
+        return self.correct(lu_solve((self.lu, self.piv), B, check_finite=False))
+
+    # Forward/back substitution with the stored factors.  b is a vector or an
+    # (N, S) matrix of S right-hand sides.  The result is a buffer owned by
+    # the solver and is overwritten by the next call.
+    def step_solve(self, b):
+        if self.x.shape != b.shape:
+            self.x = np.zeros(b.shape, dtype=np.float64, order='F')
+        if self.sparse:
+            if not self.permuted:
+                return self.correct(self.lu.solve(b))
+            self.x[self.col_order] = self.lu.solve(b)
+            return self.correct(self.x)
+        self.x[...] = b
+        x, info = self.getrs(self.lu, self.piv, self.x, overwrite_b=1)
+        return self.correct(x)
+
+
+# Integration methods for C and L: forward Euler, backward Euler, trapezoidal
+# and Gear-2 (BDF2).  The implicit ones use companion models: the branch row
+# of a capacitor becomes  x[u] - x[v] + alpha * x[p] = rhs  and that of an
+# inductor  x[p] + beta * (x[u] - x[v]) = rhs,  so only the alpha/beta entries
+# of the matrix depend on the step.  Gear-2 uses the variable-step BDF2
+# coefficients, which also depend on the ratio w = h / h_prev of the step to
+# the previous one and reduce to 2h/3, 4/3 and -1/3 at w = 1.
+METHODS = ('fe', 'be', 'trap', 'gear2')
+# (leading coefficient, order) of each method's local truncation error
+LTE_COEFF = {'fe': (1 / 2, 1), 'be': (1 / 2, 1), 'trap': (1 / 12, 2), 'gear2': (2 / 9, 2)}
+
+
+# Capacitor and inductor states and AC sources gathered into arrays, so that
+# one time step costs a fixed number of NumPy operations regardless of how
+# many reactive elements the circuit has.  The initial C/L states and the AC
+# amplitudes are read from the right-hand side b; a b with one column per
+# scenario therefore advances all scenarios together.
+class Transient:
+    def __init__(self, registry, method='trap'):
+        if method not in METHODS:
+            raise ValueError('Unknown integration method \'%s\'' % method)
+        caps = np.flatnonzero(registry.type == TYPE_CODE['C'])
+        inds = np.flatnonzero(registry.type == TYPE_CODE['L'])
+        acs = np.flatnonzero(registry.type == TYPE_CODE['AC'])
+
+        self.method = method
+        self.b = registry.b
+        self.cap_branch = registry.branch[caps]
+        self.cap_u = registry.u[caps]
+        self.cap_v = registry.v[caps]
+        self.cap_val = self.b[self.cap_branch].copy()
+        self.cap_k = 1 / registry.factor[caps]
+        self.ind_branch = registry.branch[inds]
+        self.ind_u = registry.u[inds]
+        self.ind_v = registry.v[inds]
+        self.ind_val = self.b[self.ind_branch].copy()
+        self.ind_k = 1 / registry.factor[inds]
+        self.ac_branch = registry.branch[acs]
+        self.ac_amp = self.b[self.ac_branch].copy()
+        self.ac_omega = registry.factor[acs]
+        self.cap_prev = None
+        self.ind_prev = None
+        self.h_prev = None
+
+    # Per-element coefficient a shaped to broadcast against the states
+    def per_element(self, a):
+        return np.asarray(a)[..., None] if self.b.ndim == 2 else a
+
+    def values(self):
+        return np.concatenate([self.cap_val, self.ind_val])
+
+    # Time derivatives of the capacitor voltages and inductor currents
+    def derivative(self, x):
+        return np.concatenate([-x[self.cap_branch] * self.per_element(self.cap_k),
+                               (x[self.ind_v] - x[self.ind_u]) * self.per_element(self.ind_k)])
+
+    def coefficients(self, h, method, ratio=1.0):
+        scale = {'fe': 0.0, 'be': h, 'trap': h / 2, 'gear2': h * (1 + ratio) / (1 + 2 * ratio)}[method]
+        return scale * self.cap_k, scale * self.ind_k
+
+    # System matrix of one step of size h: the step-independent matrix A
+    # from solve() plus the companion-model alpha/beta entries.
+    def matrix(self, A, h, method, ratio=1.0):
+        alpha, beta = self.coefficients(h, method, ratio)
+        rows = np.concatenate([self.cap_branch, self.ind_branch, self.ind_branch])
+        cols = np.concatenate([self.cap_branch, self.ind_u, self.ind_v])
+        vals = np.concatenate([alpha, beta, -beta])
+        return A + sp.csr_matrix((vals, (rows, cols)), shape=A.shape)
+
+    # Right-hand sides of the branch rows are linear in the states:
+    #   cap: cv * v + ci * i_c + cp * v_prev    ind: li * i + lv * w + lp * i_prev
+    # with v, i_c the capacitor voltage and current and i, w the inductor
+    # current and voltage at the previous step.  Returns (cv, ci, cp, li, lv, lp).
+    def rhs_coefficients(self, h, method, ratio=1.0):
+        if method == 'fe':
+            return 1.0, h * self.cap_k, 0.0, 1.0, h * self.ind_k, 0.0
+        if method == 'be':
+            return 1.0, 0.0, 0.0, 1.0, 0.0, 0.0
+        if method == 'trap':
+            return 1.0, h / 2 * self.cap_k, 0.0, 1.0, h / 2 * self.ind_k, 0.0
+        cur = (1 + ratio) ** 2 / (1 + 2 * ratio)
+        prev = -ratio ** 2 / (1 + 2 * ratio)
+        return cur, 0.0, prev, cur, 0.0, prev
+
+    # The C/L history, so that a rejected step can be undone
+    def save(self):
+        return self.cap_val, self.ind_val, self.cap_prev, self.ind_prev, self.h_prev
+
+    def restore(self, saved):
+        self.cap_val, self.ind_val, self.cap_prev, self.ind_prev, self.h_prev = saved
+
+    # Read the C/L states from the solution x of the previous step and write
+    # the right-hand side for the solve at time t = t_prev + h.  Returns the
+    # method actually used and the step ratio of Gear-2, which starts with
+    # backward Euler while it has no history.
+    def step(self, x, t, h):
+        self.cap_val = x[self.cap_u] - x[self.cap_v]
+        self.ind_val = x[self.ind_branch]
+        cap_cur = -x[self.cap_branch]
+        ind_volt = x[self.ind_v] - x[self.ind_u]
+
+        method = self.method
+        ratio = 1.0
+        if method == 'gear2':
+            if self.cap_prev is None:
+                method = 'be'
+            else:
+                ratio = h / self.h_prev
+        cv, ci, cp, li, lv, lp = self.rhs_coefficients(h, method, ratio)
+        cap_rhs = cv * self.cap_val + self.per_element(ci) * cap_cur
+        ind_rhs = li * self.ind_val + self.per_element(lv) * ind_volt
+        if method == 'gear2':
+            cap_rhs += cp * self.cap_prev
+            ind_rhs += lp * self.ind_prev
+        self.cap_prev = self.cap_val
+        self.ind_prev = self.ind_val
+        self.h_prev = h
+
+        self.b[self.cap_branch] = cap_rhs
+        self.b[self.ind_branch] = ind_rhs
+        self.b[self.ac_branch] = self.per_element(np.cos(self.ac_omega * t)) * self.ac_amp
+        return method, ratio
+
+
+# Concatenation of the ranges starts[k]:stops[k]
+def _ranges(starts, stops):
+    lengths = stops - starts
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+
+# Assembled MNA stamps with the CSR pattern they produce.  Entries owned by a
+# resistor hold a coefficient that is multiplied by its conductance, entries
+# owned by a controlled source one multiplied by its gain, and
+# right-hand-side entries hold the index of the source whose value they take,
+# so new component values can be stamped into the same pattern in O(nnz).
+class Stamps:
+    def __init__(self, shape, rows, cols, coef, owner, b_rows, b_owner, pattern=None):
+        self.shape = shape
+        self.coef = coef
+        self.owner = owner
+        self.b_rows = b_rows
+        self.b_owner = b_owner
+        if pattern is None:
+            keys, slot = np.unique(rows * shape[1] + cols, return_inverse=True)
+            pattern = slot, keys % shape[1], np.searchsorted(keys // shape[1], np.arange(shape[0] + 1))
+        self.slot, self.indices, self.indptr = pattern
+        # Entries sorted by owner and by slot, built by update()
+        self.by_owner = None
+
+    # Arrays that rebuild these stamps through from_arrays() without
+    # recomputing the pattern
+    def arrays(self):
+        return {'shape': np.array(self.shape), 'coef': self.coef, 'owner': self.owner, 'b_rows': self.b_rows,
+                'b_owner': self.b_owner, 'slot': self.slot, 'indices': self.indices, 'indptr': self.indptr}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(tuple(arrays['shape'].tolist()), None, None, arrays['coef'], arrays['owner'], arrays['b_rows'],
+                   arrays['b_owner'], (arrays['slot'], arrays['indices'], arrays['indptr']))
+
+    @staticmethod
+    def gains(vals, is_r):
+        g = np.array(vals, dtype=np.float64)
+        g[is_r] = 1 / vals[is_r]
+        return g
+
+    def matrix(self, vals, is_r):
+        g = self.gains(vals, is_r)
+        data = self.coef * np.where(self.owner >= 0, g[self.owner], 1.0)
+        data = np.bincount(self.slot, weights=data, minlength=len(self.indices))
+        return sp.csr_matrix((data, self.indices.copy(), self.indptr.copy()), shape=self.shape)
+
+    # Recompute in place the entries of A (as built by matrix()) that the
+    # elements in rows feed, summed in the same order as matrix() does.
+    # Returns the number of entries touched.
+    def update(self, A, vals, is_r, rows):
+        if self.by_owner is None:
+            self.by_owner = np.argsort(self.owner, kind='stable')
+            self.owner_sorted = self.owner[self.by_owner]
+            self.by_slot = np.argsort(self.slot, kind='stable')
+            self.slot_start = np.searchsorted(self.slot[self.by_slot], np.arange(len(self.indices) + 1))
+        entries = self.by_owner[_ranges(np.searchsorted(self.owner_sorted, rows),
+                                        np.searchsorted(self.owner_sorted, rows, side='right'))]
+        slots = np.unique(self.slot[entries])
+        feeding = self.by_slot[_ranges(self.slot_start[slots], self.slot_start[slots + 1])]
+        g = self.gains(vals, is_r)
+        owner = self.owner[feeding]
+        data = self.coef[feeding] * np.where(owner >= 0, g[owner], 1.0)
+        A.data[slots] = np.bincount(np.searchsorted(slots, self.slot[feeding]), weights=data, minlength=len(slots))
+        return len(slots)
+
+    # vals holds one value per component, or one column per scenario
+    def rhs(self, vals):
+        if vals.ndim == 1:
+            return np.bincount(self.b_rows, weights=vals[self.b_owner], minlength=self.shape[0])
+        b = np.zeros((self.shape[0], vals.shape[1]), dtype=np.float64)
+        np.add.at(b, self.b_rows, vals[self.b_owner])
+        return b
 
 
 reg = ComponentRegistry()
 
 
+# Fields after the name: nodes and value, then factor, controlling nodes or
+# controlling element.  The devices are
+#   D<n> anode cathode Is n            (saturation current, emission coefficient)
+#   M<n> drain source K gate Vth       (NMOS, K = KP * W / L)
+#   SW<n> u v Ron ctl_u ctl_v Vt       (on above Vt between the control nodes)
+FIELDS = {'R': 3, 'VS': 3, 'CS': 3, 'C': 4, 'L': 4, 'AC': 4, 'VCVS': 5, 'VCCS': 5, 'CCVS': 4, 'CCCS': 4,
+          'D': 4, 'M': 5, 'SW': 6}
+
+LINE_RE = re.compile(r'([A-Z]+)([0-9]+)((?:\s+\S+){3,6})\s*$')
+
+
+class NetlistError(ValueError):
+    def __init__(self, name, line, message):
+        super().__init__('%s:%d: %s' % (name, line, message))
+        self.name = name
+        self.line = line
+
+
+# A parsed netlist in columnar form: one array per registry column, one entry
+# per element in file order, and the line number of each element.
+class Netlist:
+    def __init__(self, type, nid, u, v, val, factor, ref_u, ref_v, ref, line):
+        self.type = type
+        self.nid = nid
+        self.u = u
+        self.v = v
+        self.val = val
+        self.factor = factor
+        self.ref_u = ref_u
+        self.ref_v = ref_v
+        self.ref = ref
+        self.line = line
+
+    def __len__(self):
+        return len(self.type)
+
+
+# Read a netlist one line at a time into typed arrays, so time and memory
+# grow linearly with the file and no per-line objects are kept.  Blank lines
+# and lines starting with '*' are skipped.  Malformed lines raise
+# NetlistError with the file name and line number.
+def parse_netlist(name):
+    type_ = array('b')
+    nid = array('q')
+    u = array('q')
+    v = array('q')
+    val = array('d')
+    factor = array('d')
+    ref_u = array('q')
+    ref_v = array('q')
+    ref = array('q')
+    lines = array('q')
+    with open(name, 'r') as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line[0] == '*':
+                continue
+            match = LINE_RE.match(line)
+            if not match:
+                raise NetlistError(name, line_no, 'cannot parse \'%s\'' % line)
+            _type, number, rest = match.groups()
+            if _type not in TYPE_CODE:
+                raise NetlistError(name, line_no, 'unrecognized type \'%s\'' % _type)
+            fields = rest.split()
+            if len(fields) != FIELDS[_type]:
+                raise NetlistError(name, line_no, '%s takes %d fields, got %d' % (_type, FIELDS[_type], len(fields)))
+            try:
+                nodes = int(fields[0]), int(fields[1])
+                value = float(fields[2])
+                extra = fields[3:]
+                if _type in ['C', 'L', 'AC', 'D']:
+                    extra = [float(extra[0]), 0, 0, -1]
+                elif _type == 'M':
+                    extra = [float(extra[1]), int(extra[0]), nodes[1], -1]
+                elif _type == 'SW':
+                    extra = [float(extra[2]), int(extra[0]), int(extra[1]), -1]
+                elif _type in ['VCVS', 'VCCS']:
+                    extra = [0.0, int(extra[0]), int(extra[1]), -1]
+                elif _type in ['CCVS', 'CCCS']:
+                    extra = [0.0, 0, 0, name_key(extra[0])]
+                else:
+                    extra = [0.0, 0, 0, -1]
+            except KeyError as e:
+                raise NetlistError(name, line_no, 'cannot recognize reference component %s' % e) from None
+            except ValueError as e:
+                raise NetlistError(name, line_no, str(e)) from None
+            if min(nodes + tuple(extra[1:3])) < 0:
+                raise NetlistError(name, line_no, 'negative node number')
+            type_.append(TYPE_CODE[_type])
+            nid.append(int(number))
+            u.append(nodes[0])
+            v.append(nodes[1])
+            val.append(value)
+            factor.append(extra[0])
+            ref_u.append(extra[1])
+            ref_v.append(extra[2])
+            ref.append(extra[3])
+            lines.append(line_no)
+    netlist = Netlist(np.frombuffer(type_, dtype=np.int8), np.frombuffer(nid, dtype=np.int64),
+                      np.frombuffer(u, dtype=np.int64), np.frombuffer(v, dtype=np.int64),
+                      np.frombuffer(val, dtype=np.float64), np.frombuffer(factor, dtype=np.float64),
+                      np.frombuffer(ref_u, dtype=np.int64), np.frombuffer(ref_v, dtype=np.int64), np.frombuffer(ref, dtype=np.int64),
+                      np.frombuffer(lines, dtype=np.int64))
+    check_netlist(name, netlist)
+    return netlist
+
+
+# Checks of a whole netlist: type codes and nodes, duplicate names and
+# references to missing elements, found on the arrays rather than with a
+# per-line set
+def check_netlist(name, netlist):
+    bad = np.flatnonzero((netlist.type < 0) | (netlist.type >= len(TYPES)))
+    if len(bad):
+        raise NetlistError(name, int(netlist.line[bad[0]]), 'unrecognized type code %d' % netlist.type[bad[0]])
+    bad = np.flatnonzero(np.minimum.reduce([netlist.u, netlist.v, netlist.ref_u, netlist.ref_v]) < 0)
+    if len(bad):
+        raise NetlistError(name, int(netlist.line[bad[0]]), 'negative node number')
+    bad = zero_values(netlist)
+    if len(bad):
+        raise NetlistError(name, int(netlist.line[bad[0]]), zero_message(netlist, bad[0]))
+    key = netlist.nid * len(TYPES) + netlist.type
+    order = np.argsort(key, kind='stable')
+    dup = np.flatnonzero(key[order][1:] == key[order][:-1])
+    if len(dup):
+        k = np.argmin(order[dup + 1])
+        first, second = order[dup[k]], order[dup[k] + 1]
+        raise NetlistError(name, int(netlist.line[second]), 'duplicate element \'%s\' (first on line %d)'
+                           % (key_name(key[second]), netlist.line[first]))
+    missing = np.flatnonzero((netlist.ref >= 0) & ~np.isin(netlist.ref, key))
+    if len(missing):
+        raise NetlistError(name, int(netlist.line[missing[0]]), 'cannot recognize reference component \'%s\''
+                           % key_name(netlist.ref[missing[0]]))
+
+
+# Rows of a Netlist or registry whose value leaves the system undefined:
+# resistors of zero ohms, and capacitors and inductors of zero capacitance
+# or inductance (their factor)
+def zero_values(netlist):
+    return np.flatnonzero(((netlist.type == TYPE_CODE['R']) & (netlist.val == 0))
+                          | (np.isin(netlist.type, [TYPE_CODE['C'], TYPE_CODE['L']]) & (netlist.factor == 0)))
+
+
+def zero_message(netlist, row):
+    _type = TYPES[netlist.type[row]]
+    quantity = {'R': 'resistance', 'C': 'capacitance', 'L': 'inductance'}[_type]
+    return '%s%d has zero %s' % (_type, netlist.nid[row], quantity)
+
+
+# Fields written after the name of each type, in the order FIELDS counts them
+WRITE_FIELDS = {
+    'R': ('u', 'v', 'val'), 'VS': ('u', 'v', 'val'), 'CS': ('u', 'v', 'val'),
+    'C': ('u', 'v', 'val', 'factor'), 'L': ('u', 'v', 'val', 'factor'), 'AC': ('u', 'v', 'val', 'factor'),
+    'VCVS': ('u', 'v', 'val', 'ref_u', 'ref_v'), 'VCCS': ('u', 'v', 'val', 'ref_u', 'ref_v'),
+    'CCVS': ('u', 'v', 'val', 'ref'), 'CCCS': ('u', 'v', 'val', 'ref'),
+    'D': ('u', 'v', 'val', 'factor'), 'M': ('u', 'v', 'val', 'ref_u', 'factor'),
+    'SW': ('u', 'v', 'val', 'ref_u', 'ref_v', 'factor'),
+}
+
+
+# Write a Netlist or a ComponentRegistry (anything with the registry
+# columns) to a file that read_netlist() reads back exactly.  A name ending
+# in .npz gets the compressed binary format, the columns as arrays of an
+# .npz file; anything else a text netlist with every value written by
+# repr(), which round-trips every float.
+def write_netlist(name, netlist):
+    if name.endswith('.npz'):
+        with open(name, 'wb') as f:
+            np.savez_compressed(f, **{column: getattr(netlist, column) for column in COLUMNS})
+        return
+    columns = {column: getattr(netlist, column).tolist() for column in COLUMNS}
+    columns['ref'] = [key_name(key) if key >= 0 else '' for key in columns['ref']]
+    formats = {code: '%s%%d' % _type + ''.join(' %r' if field in ['val', 'factor'] else ' %s'
+                                                for field in WRITE_FIELDS[_type]) + '\n'
+               for code, _type in enumerate(TYPES)}
+    fields = {code: [columns[field] for field in WRITE_FIELDS[_type]] for code, _type in enumerate(TYPES)}
+    with open(name, 'w', buffering=1 << 20) as f:
+        f.writelines(formats[code] % ((columns['nid'][k],) + tuple(column[k] for column in fields[code]))
+                     for k, code in enumerate(columns['type']))
+
+
+# Read a netlist written by write_netlist() or by hand: the binary format if
+# the file is a zip archive, text otherwise.  Errors in a binary netlist
+# give the element number in place of the line.
+def read_netlist(name):
+    if not zipfile.is_zipfile(name):
+        return parse_netlist(name)
+    try:
+        with np.load(name) as data:
+            columns = [data[column].astype(dtype) for column, dtype in COLUMNS.items()]
+    except (KeyError, ValueError, zipfile.BadZipFile):
+        raise NetlistError(name, 0, 'not a netlist file') from None
+    netlist = Netlist(*columns, np.arange(1, len(columns[0]) + 1))
+    check_netlist(name, netlist)
+    return netlist
+
+
 def file_input(name):
     reg.clear()
-    with open(name, 'r') as f:
-        # n, m = [int(x) for x in f.readline().strip().split()]
-        # print(n)
-        # print(m)
-        for line in f.readlines():
-            line = line.strip().split()
-            match = re.match(r'([A-Z]+)([0-9]+)', line[0])
-            _type = match.group(1)
-            nid = int(match.group(2))
-            u = int(line[1])
-            v = int(line[2])
-            val = float(line[3])
-            if _type in ['VS', 'CS', 'R']:
-                reg.add_component(Component(_type, nid, u, v, val, 0.0, 0, 0, ''))
-            elif _type in ['VCVS', 'VCCS']:
-                ref_u = int(line[4])
-                ref_v = int(line[5])
-                reg.add_component(Component(_type, nid, u, v, val, 0.0, ref_u, ref_v, ''))
-            elif _type in ['CCVS', 'CCCS']:
-                ref_comp = line[4]
-                if not reg.has_component(ref_comp):
-                    print('Cannot recognize reference component \'%s\'' % ref_comp, file=sys.stderr)
-            elif _type in ['C', 'L', 'AC']:
-                factor = float(line[4])
-                print(factor)
-                reg.add_component(Component(_type, nid, u, v, val, factor, 0, 0, ''))
-            else:
-                print('Unrecognized type \'%s\'' % _type, file=sys.stderr)
+    reg.extend(read_netlist(name))
+
+
+# Compiled netlists are cached in this directory next to the netlist, one
+# file per netlist named after the SHA-1 of its content
+CACHE_DIR = '__spicy_cache__'
+CACHE_VERSION = 3
+
+
+def netlist_hash(name):
+    digest = hashlib.sha1(b'%d:' % CACHE_VERSION)
+    with open(name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_path(name, digest):
+    head, tail = os.path.split(os.path.abspath(name))
+    return os.path.join(head, CACHE_DIR, '%s-%s.npz' % (tail, digest))
+
+
+# file_input() followed by solve(), served from the cache when the netlist is
+# unchanged since it was last compiled.  The cache holds the registry
+# columns, the branch rows, the assembled stamp pattern and the column
+# orders of the sparse factorizations of A and of the step matrices (added
+# by the first simulation); A and b are restamped from them, which costs
+# O(nnz), and the factorizations skip the SuperLU ordering phase.  Loading
+# the same file again after only values were edited goes through update()
+# and keeps the factorizations.
+def load(name, sparse=None, cache=True):
+    source = os.path.abspath(name)
+    if reg.stamps is not None and reg.source == source and sparse in [None, reg.solver.sparse]:
+        if update_values(read_netlist(name)):
+            return
+    try:
+        build(name, source, sparse, cache)
+    except ValueError:
+        reg.stamps = None
+        raise
+
+
+# The full compilation behind load()
+def build(name, source, sparse, cache):
+    if not cache:
+        file_input(name)
+        solve(sparse)
+        reg.source = source
+        return
+    digest = netlist_hash(name)
+    path = cache_path(name, digest)
+    try:
+        with np.load(path) as data:
+            reg.clear()
+            reg.extend(Netlist(*[data[column] for column in COLUMNS], None))
+            reg.branch = data['branch']
+            reg.stamps = Stamps.from_arrays(data)
+            col_order = data['col_order'] if 'col_order' in data else None
+            step_order = data['step_order'] if 'step_order' in data else None
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        file_input(name)
+        solve(sparse)
+        save_cache(path, reg.solver)
+        reg.source = source
+        reg.cache = path
+        return
+    restamp()
+    if sparse is None:
+        sparse = reg.A.shape[0] > DENSE_LIMIT
+    reg.solver = Solver(reg.A, sparse, col_order if sparse else None)
+    reg.step_order = step_order if sparse else None
+    reg.source = source
+    reg.cache = path
+    if sparse and col_order is None:
+        save_cache(path, reg.solver)
+
+
+# Take over the values of a parsed netlist that has the same elements, with
+# the same nodes and references, as the compiled registry (in any order).
+# Returns False, changing nothing, if the structure differs.
+def update_values(netlist):
+    if len(netlist) != reg.size:
+        return False
+    rows = reg.rows(netlist.nid * len(TYPES) + netlist.type)
+    if np.any(rows < 0):
+        return False
+    for column in ['u', 'v', 'ref_u', 'ref_v', 'ref']:
+        if not np.array_equal(getattr(reg, column)[rows], getattr(netlist, column)):
+            return False
+    changed = (reg.val[rows] != netlist.val) | (reg.factor[rows] != netlist.factor)
+    reg.val[rows[changed]] = netlist.val[changed]
+    reg.factor[rows[changed]] = netlist.factor[changed]
+    update(rows[changed])
+    return True
+
+
+def save_cache(path, solver):
+    arrays = {column: getattr(reg, column) for column in COLUMNS}
+    arrays.update(reg.stamps.arrays())
+    arrays['branch'] = reg.branch
+    if solver.sparse:
+        arrays['col_order'] = solver.col_order
+    if reg.step_order is not None:
+        arrays['step_order'] = reg.step_order
+    write_cache(path, arrays)
+
+
+# Add arrays to an existing cache file.  The cached columns are kept as they
+# are: the registry may hold changed values by now.
+def add_to_cache(path, **arrays):
+    try:
+        with np.load(path) as data:
+            cached = dict(data)
+    except (OSError, ValueError, zipfile.BadZipFile):
+        return
+    cached.update(arrays)
+    write_cache(path, cached)
+
+
+def write_cache(path, arrays):
+    head, tail = os.path.split(path)
+    prefix = tail.rsplit('-', 1)[0] + '-'
+    try:
+        os.makedirs(head, exist_ok=True)
+        # Write under a temporary name and rename, so a concurrent reader
+        # never sees a partial file; older versions of the netlist go away
+        with tempfile.NamedTemporaryFile(dir=head, suffix='.npz', delete=False) as f:
+            np.savez(f, **arrays)
+        os.replace(f.name, path)
+        for old in os.listdir(head):
+            if old.startswith(prefix) and old != tail and old.endswith('.npz'):
+                os.remove(os.path.join(head, old))
+    except OSError:
+        pass
 
 
-def solve():
+def solve(sparse=None):
     n = reg.getN()
     m = reg.getM()
-    power_number = 0
-
-    for comp in reg.comps:
-        if comp.type != 'R':
-            power_number += 1
-            if comp.type in ['CCVS', 'CCCS'] and reg.get_component(comp.ref_comp).type == 'R':
-                power_number += 1
+    R, VS, CS, C, L, AC, VCVS, VCCS, CCVS, CCCS, D, M, SW = range(len(TYPES))
+    reg.step_order = None
+    type_ = reg.type
+    u = reg.u
+    v = reg.v
 
+    # One branch row per element other than R, and a second one for a
+    # CCVS/CCCS controlled by the current of a resistor which holds that
+    # current
+    controlled = np.flatnonzero(np.isin(type_, [CCVS, CCCS]))
+    ref = reg.rows(reg.ref[controlled])
+    if np.any(ref < 0):
+        k = controlled[np.argmax(ref < 0)]
+        raise ValueError('%s refers to unknown element \'%s\'' % (key_name(reg.keys()[k]), key_name(reg.ref[k])))
+    if np.any(np.isin(type_[ref], [D, M, SW])):
+        k = controlled[np.argmax(np.isin(type_[ref], [D, M, SW]))]
+        raise ValueError('%s cannot be controlled by the current of device \'%s\'' % (key_name(reg.keys()[k]),
+                                                                                     key_name(reg.ref[k])))
+    by_r = type_[ref] == R
+    has_branch = np.flatnonzero(~np.isin(type_, [R, D, M, SW]))
+    power_number = len(has_branch) + np.count_nonzero(by_r)
     equ_number = n + power_number
-    used_power_number = 0
-    power_id = {}
-
-    A = np.zeros((equ_number, equ_number), dtype=np.float64)
-    b = np.zeros(equ_number, dtype=np.float64)
-
-    for i in range(n):
-        for comp in reg.forward(i):
-            if comp.type == 'R':
-                A[i][comp.u] += 1 / comp.val
-                A[i][comp.v] += -1 / comp.val
-            elif comp.type in ['VS', 'C', 'AC']:
-                p = n + used_power_number
-                A[i][p] += -1
-                if comp.type == 'C':
-                    reg.current_note[comp.type + str(comp.nid)] = p
-                    reg.dynamic_place[comp.type + str(comp.nid)] = p
-                if comp.type == 'AC':
-                    reg.dynamic_place[comp.type + str(comp.nid)] = p
-                A[comp.v][p] += 1
-                A[p][comp.u] += 1
-                A[p][comp.v] += -1
-                b[p] += comp.val
-                power_id[comp.type + str(comp.nid)] = p
-                used_power_number += 1
-            elif comp.type in ['CS', 'L']:
-                p = n + used_power_number
-                A[i][p] += -1
-                A[comp.v][p] += 1
-                A[p][p] += 1
-                b[p] += comp.val
-                if comp.type == 'L':
-                    reg.dynamic_place[comp.type + str(comp.nid)] = p
-                power_id[comp.type + str(comp.nid)] = p
-                used_power_number += 1
-            # elif comp.type == 'VCCS':
-            #     p = n + used_power_number
-            #     A[i][p] += -1
-            #     A[comp.v][p] += 1
-            #     A[p][comp.ref_u] += -comp.val
-            #     A[p][comp.ref_v] += comp.val
-            #     A[p][p] += 1
-            #     power_id[comp.type + comp.nid] = p
-            #     used_power_number += 1
-            # elif comp.type == 'CCVS':
-            #     p = n + used_power_number
-            #     ref_comp = reg.get_component(comp.ref_comp)
-            #     if ref_comp.type == 'R':
-            #         A[p][ref_comp.u] += -1/comp.val
-            #         A[p][ref_comp.v] += 1/comp.val
-            #         A[p][p] += 1
-            #         p += 1
-            #         A[p][p - 1] += -comp.val
-            #         A[p][comp.u] += 1
-            #         A[p][comp.v] += -1
-            #     else:
-        for comp in reg.backward(i):
-            if comp.type == 'R':
-                A[i][comp.u] += -1 / comp.val
-                A[i][comp.v] += 1 / comp.val
-
-    A[0][0] = 1
-    print('A:')
-    print(A)
-    print('b:')
-    print(b)
-
-    reg.inv_A = np.linalg.inv(A)
-    reg.b = b
-
-    # t = 0
-    # delta_t = 1e-5
-    # tt = []
-    # seq = []
-    # # hl, = plt.plot([], [])
-    # tick = 0
-    # plt.plot([], [])
-    # plt.pause(0.001)
-    # tic = time.time()
-    # while t < 1:
-    #     print(b)
-    #     x = (reg.inv_A).dot(b)
-    #     tt.append(t)
-    #     seq.append(x[2])
-    #     # print(t, x[2])
-    #     if tick % 300 == 0:
-    #         plt.clf()
-    #         plt.plot(tt, seq)
-    #         plt.pause(0.001)
-    #     # hl.set_xdata(tt)
-    #     # hl.set_ydata(seq)
-    #     # plt.draw()
-    #     # plt.pause(0.01)
-    #     for comp in reg.comps:
-    #         name = comp.type + str(comp.nid)
-    #         if comp.type == 'C':
-    #             comp.val += -x[reg.current_note[name]] / comp.factor * delta_t
-    #             b[reg.dynamic_place[name]] = comp.val
-    #         elif comp.type == 'L':
-    #             comp.val += (x[comp.v] - x[comp.u]) / comp.factor * delta_t
-    #             b[reg.dynamic_place[name]] = comp.val
-    #     t += delta_t
-    #     tick += 1
-    # toc = time.time()
-    # print('%d iterations in %.2f sec, %d iter/s' % (tick, toc - tic, tick / (toc - tic)))
-    # plt.show()
-
-
-def main():
-    file_input('input.txt')
-
-    for comp in reg.comps:
-        print(comp)
-
-    solve()
+
+    # Branch rows are numbered by the node an element leaves, then in
+    # registry order; the resistor current rows come last
+    has_branch = has_branch[np.argsort(u[has_branch], kind='stable')]
+    reg.branch = np.full(m, -1, dtype=np.int64)
+    reg.branch[has_branch] = n + np.arange(len(has_branch))
+    sense = np.empty(len(controlled), dtype=np.int64)
+    sense[by_r] = n + len(has_branch) + np.arange(np.count_nonzero(by_r))
+    sense[~by_r] = reg.branch[ref[~by_r]]
+
+    rows = []
+    cols = []
+    coef = []
+    owner = []
+
+    # Entries with an owner k are multiplied by the conductance of resistor k
+    # or the value (gain) of any other element k
+    def stamp(r, c, val, k=None):
+        rows.append(r)
+        cols.append(c)
+        coef.append(np.broadcast_to(np.asarray(val, dtype=np.float64), len(r)))
+        owner.append(np.full(len(r), -1, dtype=np.int64) if k is None else k)
+
+    k = np.flatnonzero(type_ == R)
+    stamp(u[k], u[k], 1, k)
+    stamp(u[k], v[k], -1, k)
+    stamp(v[k], u[k], -1, k)
+    stamp(v[k], v[k], 1, k)
+    # Devices: a GMIN conductance in parallel, which keeps a node between
+    # two devices from leaving A singular; the rest is added by Devices
+    k = np.flatnonzero(np.isin(type_, [D, M, SW]))
+    stamp(u[k], u[k], GMIN)
+    stamp(u[k], v[k], -GMIN)
+    stamp(v[k], u[k], -GMIN)
+    stamp(v[k], v[k], GMIN)
+    # Every branch current leaves node u and enters node v through the
+    # element, as -x[p]
+    p = reg.branch[has_branch]
+    stamp(u[has_branch], p, -1)
+    stamp(v[has_branch], p, 1)
+    # VS, C, AC and VCVS, CCVS: the branch row holds x[u] - x[v]
+    k = np.flatnonzero(np.isin(type_, [VS, C, AC, VCVS, CCVS]))
+    p = reg.branch[k]
+    stamp(p, u[k], 1)
+    stamp(p, v[k], -1)
+    # CS, L and VCCS, CCCS: the branch row holds the branch current
+    k = np.flatnonzero(np.isin(type_, [CS, L, VCCS, CCCS]))
+    p = reg.branch[k]
+    stamp(p, p, 1)
+    # VCVS: x[u] - x[v] = gain * (x[ref_u] - x[ref_v]); VCCS likewise for the
+    # current pushed into node u
+    k = np.flatnonzero(np.isin(type_, [VCVS, VCCS]))
+    p = reg.branch[k]
+    stamp(p, reg.ref_u[k], -1, k)
+    stamp(p, reg.ref_v[k], 1, k)
+    # CCVS, CCCS: the same with the current of the controlling element from
+    # its u to its v, which is -x[p] for a branch element and the extra
+    # current row for a resistor
+    r = ref[by_r]
+    q = sense[by_r]
+    stamp(q, q, 1)
+    stamp(q, u[r], -1, r)
+    stamp(q, v[r], 1, r)
+    p = reg.branch[controlled]
+    stamp(p, sense, np.where(by_r, -1.0, 1.0), controlled)
+    independent = np.flatnonzero(np.isin(type_, [VS, CS, C, L, AC]))
+    b_owner = independent
+    b_rows = reg.branch[independent]
+
+    # Ground: replace the KCL row of node 0 by x[0] = 0
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    coef = np.concatenate(coef)
+    owner = np.concatenate(owner)
+    keep = rows != 0
+    reg.stamps = Stamps((equ_number, equ_number), np.append(rows[keep], 0), np.append(cols[keep], 0),
+                        np.append(coef[keep], 1.0), np.append(owner[keep], -1), b_rows, b_owner)
+    restamp()
+    reg.solver = Solver(reg.A, sparse)
+
+
+def check_values():
+    bad = zero_values(reg)
+    if len(bad):
+        raise ValueError(zero_message(reg, bad[0]))
+
+
+# Rebuild reg.A and reg.b from the current component values on the pattern
+# recorded by solve()
+def restamp():
+    check_values()
+    is_r = reg.type == TYPE_CODE['R']
+    reg.A = reg.stamps.matrix(reg.val, is_r)
+    reg.b = reg.stamps.rhs(reg.val)
+    reg.solvers = {}
+
+
+# Take up new values in reg.val and reg.factor of the elements in rows
+# without reassembling: only the entries of A those elements feed are
+# recomputed, b is restamped, and reg.solver and the step factorizations in
+# reg.solvers are carried over by Solver.update, so changing a few values
+# costs a low-rank correction or at most a numeric refactorization.  If the
+# new values are rejected or make a matrix singular, reg no longer matches
+# its factorizations; reg.stamps is dropped so that the next load() rebuilds
+# everything from the netlist.
+def update(rows):
+    try:
+        check_values()
+        rows = np.unique(rows)
+        A = reg.A.copy()
+        touched = reg.stamps.update(A, reg.val, reg.type == TYPE_CODE['R'], rows)
+        reg.A = A
+        reg.b = reg.stamps.rhs(reg.val)
+        if touched:
+            reg.solver.update(A)
+        if touched or np.any(np.isin(reg.type[rows], [TYPE_CODE['C'], TYPE_CODE['L']])):
+            state = Transient(reg)
+            for (h, method, ratio), solver in reg.solvers.items():
+                solver.update(state.matrix(A, h, method, ratio))
+    except ValueError:
+        reg.stamps = None
+        raise
+
+
+# Probes are (u, v) node pairs or expressions over V() and I() such as
+# 'V(3)', 'V(3,0)', 'I(L1)' or 'V(2)*I(VS1)', combined with + - * / and
+# constants.  Every V() and I() is one term  g = scale * (x[u] - x[v]),  and
+# the terms of all probes are gathered together; branch currents are read
+# from the branch row (positive from u through the element to v), resistor
+# currents from the voltage across them.  Device currents are not linear in
+# x; their terms are filled in by device_current(k, x), which gives the
+# currents of the devices k (Devices.current in a transient,
+# Devices.small_signal in an AC analysis).  Expressions are compiled once
+# into closures over g, and plain terms are gathered straight into the output.
+class Probes:
+    OPS = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply, ast.Div: np.divide}
+
+    def __init__(self, probes, registry, device_current=None):
+        self.registry = registry
+        self.device_current = device_current
+        self.u = []
+        self.v = []
+        self.scale = []
+        self.device_terms = []
+        self.device_rows = []
+        self.exprs = [self.compile(probe) for probe in probes]
+        self.u = np.array(self.u, dtype=np.intp)
+        self.v = np.array(self.v, dtype=np.intp)
+        self.scale = np.array(self.scale, dtype=np.float64)
+        self.device_terms = np.array(self.device_terms, dtype=np.intp)
+        self.devices = np.searchsorted(device_rows(registry), self.device_rows)
+        self.direct = not len(self.device_terms) and all(isinstance(expr, int) for expr in self.exprs)
+        self.scaled = np.any(self.scale != 1)
+
+    def term(self, u, v, scale):
+        self.u.append(u)
+        self.v.append(v)
+        self.scale.append(scale)
+        return len(self.u) - 1
+
+    def compile(self, probe):
+        if not isinstance(probe, str):
+            u, v = probe
+            return self.voltage(probe, [int(u), int(v)])
+        try:
+            tree = ast.parse(probe.strip(), mode='eval').body
+        except SyntaxError:
+            raise ValueError('Cannot parse probe \'%s\'' % probe) from None
+        if isinstance(tree, ast.Call):
+            return self.call(probe, tree)
+        return self.build(probe, tree)
+
+    def voltage(self, probe, nodes):
+        n = self.registry.getN()
+        if not all(type(node) is int and 0 <= node < n for node in nodes):
+            raise ValueError('Probe \'%s\' refers to a node outside 0..%d' % (probe, n - 1))
+        return self.term(nodes[0], nodes[1] if len(nodes) > 1 else 0, 1.0)
+
+    def current(self, probe, name):
+        if not self.registry.has_component(name):
+            raise ValueError('Probe \'%s\' refers to unknown element \'%s\'' % (probe, name))
+        row = self.registry.index(name)
+        if self.registry.type[row] == TYPE_CODE['R']:
+            return self.term(self.registry.u[row], self.registry.v[row], 1 / self.registry.val[row])
+        if TYPES[self.registry.type[row]] in DEVICE_TYPES and self.device_current is not None:
+            self.device_rows.append(row)
+            self.device_terms.append(self.term(0, 0, 1.0))
+            return self.device_terms[-1]
+        if self.registry.branch[row] < 0:
+            raise ValueError('Probe \'%s\': the current of %s is not available' % (probe, name))
+        return self.term(0, self.registry.branch[row], 1.0)
+
+    def call(self, probe, node):
+        if isinstance(node.func, ast.Name) and not node.keywords:
+            args = node.args
+            if node.func.id == 'V' and len(args) in [1, 2] and all(isinstance(a, ast.Constant) for a in args):
+                return self.voltage(probe, [a.value for a in args])
+            if node.func.id == 'I' and len(args) == 1 and isinstance(args[0], ast.Name):
+                return self.current(probe, args[0].id)
+        raise ValueError('Cannot parse probe \'%s\': expected V(node), V(node,node) or I(element)' % probe)
+
+    def build(self, probe, node):
+        if isinstance(node, ast.Call):
+            j = self.call(probe, node)
+            return lambda g: g[j]
+        if isinstance(node, ast.Constant) and type(node.value) in [int, float]:
+            value = node.value
+            return lambda g: value
+        if isinstance(node, ast.UnaryOp) and type(node.op) in [ast.USub, ast.UAdd]:
+            operand = self.build(probe, node.operand)
+            if isinstance(node.op, ast.UAdd):
+                return operand
+            return lambda g: -operand(g)
+        if isinstance(node, ast.BinOp) and type(node.op) in self.OPS:
+            op = self.OPS[type(node.op)]
+            left = self.build(probe, node.left)
+            right = self.build(probe, node.right)
+            return lambda g: op(left(g), right(g))
+        raise ValueError('Cannot parse probe \'%s\'' % probe)
+
+    def __len__(self):
+        return len(self.exprs)
+
+    # Terms as a sparse matrix, g = matrix @ x
+    def matrix(self, N):
+        rows = np.concatenate([np.arange(len(self.u))] * 2)
+        return sp.csr_matrix((np.concatenate([self.scale, -self.scale]), (rows, np.concatenate([self.u, self.v]))),
+                             shape=(len(self.u), N))
+
+    def gather(self, x):
+        g = x[self.u] - x[self.v]
+        if self.scaled:
+            g *= self.scale.reshape((-1,) + (1,) * (x.ndim - 1))
+        if len(self.device_terms):
+            g[self.device_terms] = self.device_current(self.devices, x)
+        return g
+
+    # Probe values from terms g (with trailing axes of any shape) into out
+    def combine(self, g, out):
+        for i, expr in enumerate(self.exprs):
+            out[i] = g[expr] if isinstance(expr, int) else expr(g)
+
+    # Probe values of the solution x (a vector, or one column per scenario)
+    def evaluate(self, x, out):
+        if self.direct:
+            np.subtract(x[self.u], x[self.v], out=out)
+            if self.scaled:
+                out *= self.scale.reshape((-1,) + (1,) * (x.ndim - 1))
+        else:
+            self.combine(self.gather(x), out)
+
+
+def probe_names(probes):
+    return [probe if isinstance(probe, str) else 'V(%d,%d)' % tuple(probe) for probe in probes]
+
+
+# Adaptive steps are delta_t * 2 ** level with level in this range
+MIN_STEP_LEVEL = -16
+MAX_STEP_LEVEL = 16
+# Smallest number of steps per period of the fastest AC source
+AC_STEPS_PER_PERIOD = 32
+
+
+# Factorizations kept per (step, method) by Simulation
+SOLVER_CACHE_SIZE = 8
+
+
+# Newton-Raphson on circuits with devices: an iteration is converged when
+# every update is within NEWTON_RELTOL * |x| + NEWTON_ABSTOL
+NEWTON_MAX_ITER = 50
+NEWTON_RELTOL = 1e-6
+NEWTON_ABSTOL = 1e-9
+# The Jacobian is only refactorized when an iteration shrinks the update by
+# less than this factor, or a device voltage had to be limited
+NEWTON_CONTRACTION = 0.5
+# Devices whose voltages moved less than this keep their linearization
+BYPASS_VTOL = 1e-6
+# Thermal voltage at 300 K
+VT = 0.025852
+# Off resistance of a switch and the width of its transition around Vt
+SW_ROFF = 1e9
+SW_WIDTH = 0.01
+
+
+class ConvergenceError(RuntimeError):
+    pass
+
+
+def device_rows(registry):
+    return np.flatnonzero(np.isin(registry.type, [TYPE_CODE[_type] for _type in DEVICE_TYPES]))
+
+
+# Nonlinear devices gathered into arrays like the C/L states of Transient.
+# Every device passes a current i = f(v1, v2) from its u to its v, with v1
+# the voltage across it and v2 a controlling voltage (gate to source of a
+# MOSFET, the control nodes of a switch), and is linearized around the last
+# voltages it was evaluated at as  i0 + g1 (v1 - v1_0) + g2 (v2 - v2_0).
+# Devices whose voltages have not moved by BYPASS_VTOL keep that
+# linearization instead of being evaluated again.
+#
+# newton() solves  A x + injected device currents = b  for the step matrix
+# A of one (step, method) key by modified Newton: the Jacobian A + device
+# conductances is factorized once per key and kept across iterations and
+# time steps, and is only refactorized (on the same pattern, reusing the
+# column order) when the iteration stops contracting.
+class Devices:
+    def __init__(self, registry, sparse=None):
+        rows = device_rows(registry)
+        self.kind = registry.type[rows]
+        self.u = registry.u[rows]
+        self.v = registry.v[rows]
+        self.ref_u = registry.ref_u[rows]
+        self.ref_v = registry.ref_v[rows]
+        self.val = registry.val[rows]
+        self.factor = registry.factor[rows]
+        diode = self.kind == TYPE_CODE['D']
+        bad = np.flatnonzero((self.val <= 0) | (diode & (self.factor <= 0)))
+        if len(bad):
+            raise ValueError('%s needs positive parameters' % key_name(registry.keys()[rows[bad[0]]]))
+        self.sparse = sparse
+
+        # KCL rows the device currents enter, and the Jacobian entries of g1
+        # and g2; nothing is stamped into the ground row
+        self.rows = np.concatenate([self.u, self.v])
+        self.sign = np.concatenate([np.ones(len(rows)), -np.ones(len(rows))])
+        self.sign[self.rows == 0] = 0
+        u, v, ru, rv = self.u, self.v, self.ref_u, self.ref_v
+        self.jac_rows = np.concatenate([u, u, v, v, u, u, v, v])
+        self.jac_cols = np.concatenate([u, v, u, v, ru, rv, ru, rv])
+        one = np.ones(len(rows))
+        self.jac_sign = np.concatenate([one, -one, -one, one] * 2)
+        self.jac_sign[self.jac_rows == 0] = 0
+
+        self.v1 = np.full(len(rows), np.nan)
+        self.v2 = np.full(len(rows), np.nan)
+        self.i = np.zeros(len(rows))
+        self.g1 = np.zeros(len(rows))
+        self.g2 = np.zeros(len(rows))
+        self.systems = {}
+        self.evaluations = 0
+        self.iterations = 0
+        self.factorizations = 0
+
+    def __len__(self):
+        return len(self.kind)
+
+    @staticmethod
+    def diode(Is, n, v1, v2):
+        nvt = n * VT
+        e = np.exp(np.minimum(v1 / nvt, 80.0))
+        return Is * (e - 1), Is * e / nvt, np.zeros(len(v1))
+
+    # Level-1 NMOS without channel-length modulation; with vds < 0 the
+    # source and drain swap roles
+    @staticmethod
+    def mosfet(K, vth, v1, v2):
+        rev = v1 < 0
+        vds = np.abs(v1)
+        vov = np.where(rev, v2 - v1, v2) - vth
+        on = vov > 0
+        sat = vds >= vov
+        ids = np.where(on, np.where(sat, K / 2 * vov ** 2, K * (vov - vds / 2) * vds), 0.0)
+        gm = np.where(on, np.where(sat, K * vov, K * vds), 0.0)
+        gds = np.where(on & ~sat, K * (vov - vds), 0.0)
+        return np.where(rev, -ids, ids), np.where(rev, gds + gm, gds), np.where(rev, -gm, gm)
+
+    # Conductance moving smoothly from 1 / SW_ROFF to 1 / Ron as the control
+    # voltage passes Vt
+    @staticmethod
+    def switch(Ron, vt, v1, v2):
+        t = np.tanh((v2 - vt) / SW_WIDTH)
+        g_on = 1 / Ron - 1 / SW_ROFF
+        g = 1 / SW_ROFF + g_on * (1 + t) / 2
+        return g * v1, g, g_on * (1 - t ** 2) / (2 * SW_WIDTH) * v1
+
+    # Model currents and conductances of the devices k at (v1, v2)
+    def evaluate(self, k, v1, v2):
+        out = np.empty((3, len(k)))
+        for _type, model in [('D', self.diode), ('M', self.mosfet), ('SW', self.switch)]:
+            j = np.flatnonzero(self.kind[k] == TYPE_CODE[_type])
+            if len(j):
+                out[:, j] = model(self.val[k[j]], self.factor[k[j]], v1[j], v2[j])
+        return out
+
+    # Junction voltage limiting (pnjlim of SPICE): a diode voltage above the
+    # critical voltage moves logarithmically rather than linearly from the
+    # last one, which keeps exp() from overflowing
+    def limit(self, k, v1):
+        j = np.flatnonzero(self.kind[k] == TYPE_CODE['D'])
+        nvt = self.factor[k[j]] * VT
+        vcrit = nvt * np.log(nvt / (np.sqrt(2) * self.val[k[j]]))
+        new = v1[j]
+        old = np.nan_to_num(self.v1[k[j]])
+        big = (new > vcrit) & (np.abs(new - old) > 2 * nvt)
+        arg = 1 + (new - old) / nvt
+        step = np.where(arg > 0, old + nvt * np.log(np.maximum(arg, 1e-300)), vcrit)
+        limited = np.where(old > 0, step, nvt * np.log(np.maximum(new / nvt, 1e-300)))
+        v1 = v1.copy()
+        v1[j] = np.where(big, limited, new)
+        return v1, bool(big.any())
+
+    # Device currents at x from the (updated) linearizations, and whether
+    # any voltage was limited
+    def currents(self, x):
+        v1 = x[self.u] - x[self.v]
+        v2 = x[self.ref_u] - x[self.ref_v]
+        k = np.flatnonzero(~((np.abs(v1 - self.v1) <= BYPASS_VTOL) & (np.abs(v2 - self.v2) <= BYPASS_VTOL)))
+        limited = False
+        if len(k):
+            w1, limited = self.limit(k, v1[k])
+            self.v1[k] = w1
+            self.v2[k] = v2[k]
+            self.i[k], self.g1[k], self.g2[k] = self.evaluate(k, w1, v2[k])
+            self.evaluations += len(k)
+        return self.i + self.g1 * (v1 - self.v1) + self.g2 * (v2 - self.v2), limited
+
+    # Model currents of the devices k at the solution x
+    def current(self, k, x):
+        return self.evaluate(k, x[self.u[k]] - x[self.v[k]], x[self.ref_u[k]] - x[self.ref_v[k]])[0]
+
+    # Small-signal currents of the devices k for the phasors x (one column
+    # per frequency), with the conductances of the current linearizations
+    def small_signal(self, k, x):
+        shape = (-1,) + (1,) * (x.ndim - 1)
+        return (self.g1[k].reshape(shape) * (x[self.u[k]] - x[self.v[k]])
+                + self.g2[k].reshape(shape) * (x[self.ref_u[k]] - x[self.ref_v[k]]))
+
+    # A plus the device conductances of the current linearizations
+    def jacobian(self, A):
+        A = A.tocoo()
+        data = self.jac_sign * np.concatenate([self.g1] * 4 + [self.g2] * 4)
+        return sp.csr_matrix((np.concatenate([A.data, data]),
+                              (np.concatenate([A.row, self.jac_rows]), np.concatenate([A.col, self.jac_cols]))),
+                             shape=A.shape)
+
+    # Solve the system of key, whose matrix is built by matrix() the first
+    # time, with right-hand side b starting from x
+    def newton(self, key, matrix, b, x):
+        if key not in self.systems:
+            if len(self.systems) >= SOLVER_CACHE_SIZE:
+                del self.systems[next(iter(self.systems))]
+            self.systems[key] = [matrix(), None]
+        system = self.systems[key]
+        A = system[0]
+        x = np.array(x, dtype=np.float64)
+        refactor = system[1] is None
+        last = None
+        for _ in range(NEWTON_MAX_ITER):
+            self.iterations += 1
+            i, limited = self.currents(x)
+            F = A @ x - b
+            F += np.bincount(self.rows, weights=self.sign * np.tile(i, 2), minlength=len(F))
+            if refactor:
+                if system[1] is None:
+                    system[1] = Solver(self.jacobian(A), self.sparse)
+                else:
+                    system[1].refactor(self.jacobian(A))
+                self.factorizations += 1
+            dx = system[1].step_solve(-F)
+            x += dx
+            if not limited and np.all(np.abs(dx) <= NEWTON_RELTOL * np.abs(x) + NEWTON_ABSTOL):
+                return x
+            size = np.max(np.abs(dx))
+            refactor = limited or (last is not None and size > NEWTON_CONTRACTION * last)
+            last = size
+        raise ConvergenceError('Newton iteration did not converge in %d iterations' % NEWTON_MAX_ITER)
+
+
+class Simulation:
+    def __init__(self, delta_t, probes, adaptive=False, reltol=1e-3, abstol=1e-6, max_delta_t=None, method='trap'):
+        self.solver = reg.solver
+        self.solvers = reg.solvers
+        self.A = reg.A
+        self.state = Transient(reg, method)
+        self.b = reg.b
+        self.delta_t = delta_t
+        self.tick = 0
+        self.t = 0.0
+        self.devices = None
+        if len(device_rows(reg)):
+            if self.b.ndim == 2:
+                raise ValueError('Scenarios cannot be run together on a circuit with nonlinear devices')
+            self.devices = Devices(reg, self.solver.sparse)
+        self.probes = Probes(probes, reg, self.devices.current if self.devices is not None else None)
+        # The initial solution holds every C/L at its netlist value
+        self.x = self.solver.step_solve(self.b)
+        if self.devices is not None:
+            self.x = self.devices.newton(None, lambda: self.A, self.b, self.x)
+
+        self.adaptive = adaptive
+        self.reltol = reltol
+        self.abstol = abstol
+        self.level = 0
+        self.max_level = MAX_STEP_LEVEL
+        omega = np.abs(self.state.ac_omega).max(initial=0.0)
+        if omega > 0:
+            max_delta_t = min(max_delta_t or np.inf, 2 * np.pi / omega / AC_STEPS_PER_PERIOD)
+        if max_delta_t is not None:
+            self.max_level = min(self.max_level, int(np.floor(np.log2(max_delta_t / delta_t))))
+        self.level = min(self.level, self.max_level)
+        self.f_prev = None
+        self.d_prev = None
+        self.h_prev = None
+        self.h_prev2 = None
+        self.rejected = 0
+
+    # The matrix only changes with the step size (and the step ratio of
+    # Gear-2), so factorizations are cached per step in reg.solvers and reused
+    # whenever the step returns to a known size, also by later simulations of
+    # the same circuit.  All
+    # implicit step matrices share one pattern, so the column order found
+    # for the first one is reused by every other step size and, through
+    # reg.step_order and the cache, by later runs.  A one-off step (keep
+    # False) is factorized without being cached.
+    def factorized(self, h, method, ratio=1.0, keep=True):
+        if method == 'fe':
+            return self.solver
+        key = (h, method, ratio)
+        if key in self.solvers:
+            return self.solvers[key]
+        sparse = self.solver.sparse
+        solver = Solver(self.state.matrix(self.A, h, method, ratio), sparse, reg.step_order if sparse else None)
+        if sparse and reg.step_order is None:
+            reg.step_order = solver.col_order
+            if reg.cache is not None:
+                add_to_cache(reg.cache, step_order=solver.col_order)
+        if keep:
+            if len(self.solvers) >= SOLVER_CACHE_SIZE:
+                del self.solvers[next(iter(self.solvers))]
+            self.solvers[key] = solver
+        return solver
+
+    # Pick the next step from the local truncation error of the integration
+    # method, C * h^(p+1) * |x^(p+1)|, with the derivative of the C/L states
+    # estimated by divided differences over the previous steps.  The step
+    # only moves between powers of two of delta_t and grows by at most one
+    # level per step.
+    def choose_step(self):
+        f = self.state.derivative(self.x)
+        coeff, order = LTE_COEFF[self.state.method]
+        d = None
+        if self.f_prev is not None and len(f):
+            d = (f - self.f_prev) / self.h_prev
+            high = d
+            if order == 2:
+                high = None
+                if self.d_prev is not None:
+                    high = (d - self.d_prev) * 2 / (self.h_prev + self.h_prev2)
+            if high is not None:
+                scale = self.abstol + self.reltol * np.abs(self.state.values())
+                m = np.max(np.abs(high) / scale)
+                if m > 0:
+                    h_max = (0.8 / (coeff * m)) ** (1 / (order + 1))
+                    level = int(np.floor(np.log2(h_max / self.delta_t)))
+                    self.level = max(min(level, self.level + 1, self.max_level), MIN_STEP_LEVEL)
+                else:
+                    self.level = min(self.level + 1, self.max_level)
+        self.f_prev = f
+        self.d_prev = d
+        self.h_prev2 = self.h_prev
+        self.h_prev = self.delta_t * 2.0 ** self.level
+        return self.h_prev
+
+    # Error of the step of size h that produced x, relative to the tolerance:
+    # the same estimate as in choose_step(), with the derivative of the new
+    # solution as the latest divided difference.  0 without enough history.
+    def step_error(self, h):
+        f = self.state.derivative(self.x)
+        coeff, order = LTE_COEFF[self.state.method]
+        if not len(f):
+            return 0.0
+        high = (f - self.f_prev) / h
+        if order == 2:
+            if self.d_prev is None:
+                return 0.0
+            high = (high - self.d_prev) * 2 / (h + self.h_prev2)
+        scale = self.abstol + self.reltol * np.abs(self.state.values())
+        return coeff * h ** (order + 1) * np.max(np.abs(high) / scale)
+
+    # Solve the step of size h that ends at self.t
+    def solve_step(self, h, keep=True):
+        method, ratio = self.state.step(self.x, self.t, h)
+        if self.devices is None:
+            return self.factorized(h, method, ratio, keep).step_solve(self.b)
+        return self.devices.newton((h, method, ratio), lambda: self.state.matrix(self.A, h, method, ratio), self.b,
+                                   self.x)
+
+    # One adaptive step.  A step whose error exceeds the tolerance, or whose
+    # Newton iteration does not converge, is undone and taken again at a
+    # lower level, down to MIN_STEP_LEVEL.  The last step is cut short to end
+    # exactly at t_stop.
+    def adaptive_step(self, t_stop=np.inf):
+        h = self.choose_step()
+        t, x, saved = self.t, self.x.copy(), self.state.save()
+        coeff, order = LTE_COEFF[self.state.method]
+        while True:
+            last = t + h >= t_stop
+            if last:
+                h = self.h_prev = t_stop - t
+            self.t = t_stop if last else t + h
+            try:
+                self.x = self.solve_step(h, not last)
+                error = self.step_error(h)
+            except ConvergenceError as e:
+                if self.level == MIN_STEP_LEVEL:
+                    raise ConvergenceError('%s at t = %g' % (e, self.t)) from None
+                error = np.inf
+            if error <= 1 or self.level == MIN_STEP_LEVEL:
+                return
+            self.rejected += 1
+            level = self.level - 1
+            if np.isfinite(error):
+                level = min(level, int(np.floor(np.log2(h * (0.8 / error) ** (1 / (order + 1)) / self.delta_t))))
+            self.level = max(level, MIN_STEP_LEVEL)
+            self.x = x
+            self.state.restore(saved)
+            h = self.h_prev = self.delta_t * 2.0 ** self.level
+
+    # Record up to len(tt) samples into the preallocated tt and ys (one row
+    # per probe, or a (probes, scenarios, steps) array when reg.b holds
+    # several scenarios), advancing the circuit by one step after each sample.
+    # Stops early once the time passes t_stop, or with adaptive steps after
+    # the sample at t_stop; returns the sample count.
+    def advance(self, tt, ys, t_stop=np.inf):
+        for k in range(len(tt)):
+            if self.t > t_stop:
+                return k
+            tt[k] = self.t
+            self.probes.evaluate(self.x, ys[..., k])
+            if self.adaptive:
+                if self.t >= t_stop:
+                    return k + 1
+                self.adaptive_step(t_stop)
+                continue
+            self.tick += 1
+            self.t = self.tick * self.delta_t
+            try:
+                self.x = self.solve_step(self.delta_t)
+            except ConvergenceError as e:
+                raise ConvergenceError('%s at t = %g' % (e, self.t)) from None
+        return len(tt)
+
+
+# Fixed-step propagator of a linear circuit.  With the step h fixed, one step
+# is a linear map of the vector
+#     z = [v_c, i_c, i_l, w_l, (v_c_prev, i_l_prev for gear2), 1, cos(wt), sin(wt)]
+# of C/L states, a constant for the DC sources and a rotating phasor per AC
+# source: z[n+1] = F z[n] and the probes are y[n+1] = H z[n].  The matrices
+# are built once from the factorized MNA system; samples are then produced in
+# blocks of K steps with one matrix-vector product each,
+#     [y[n+1]; ...; y[n+K]] = W z[n],   z[n+K] = F^K z[n].
+class StateSpace:
+    def __init__(self, sim, block=1024):
+        state = sim.state
+        h = sim.delta_t
+        method = state.method
+        if sim.devices is not None:
+            raise ValueError('The state-space kernel needs a circuit without nonlinear devices')
+        if method == 'gear2' and (state.cap_prev is None or state.h_prev != h):
+            raise ValueError('Gear-2 needs one step at delta_t before the state-space kernel takes over')
+        solver = sim.factorized(h, method)
+        N = len(sim.x)
+        nc = len(state.cap_branch)
+        nl = len(state.ind_branch)
+        nac = len(state.ac_branch)
+        nread = 2 * nc + 2 * nl
+        nprev = nc + nl if method == 'gear2' else 0
+        ns = nread + nprev
+        nz = ns + 1 + 2 * nac
+
+        # Readout M: x -> [v_c, i_c, i_l, w_l]
+        r = np.arange(nread)
+        rows = np.concatenate([r[:nc], r[:nc], r[nc:2 * nc], r[2 * nc:2 * nc + nl],
+                               r[2 * nc + nl:], r[2 * nc + nl:]])
+        cols = np.concatenate([state.cap_u, state.cap_v, state.cap_branch, state.ind_branch, state.ind_v, state.ind_u])
+        vals = np.concatenate([np.ones(nc), -np.ones(nc), -np.ones(nc), np.ones(nl), np.ones(nl), -np.ones(nl)])
+        M = sp.csr_matrix((vals, (rows, cols)), shape=(nread, N))
+
+        # Right-hand side as a linear function of [s, 1, cos(w t[n+1])]
+        cv, ci, cp, li, lv, lp = state.rhs_coefficients(h, method)
+        B = np.zeros((N, ns + 1 + nac), dtype=np.float64)
+        ic = np.arange(nc)
+        il = np.arange(nl)
+        B[state.cap_branch, ic] = cv
+        B[state.cap_branch, nc + ic] = ci
+        B[state.ind_branch, 2 * nc + il] = li
+        B[state.ind_branch, 2 * nc + nl + il] = lv
+        if nprev:
+            B[state.cap_branch, nread + ic] = cp
+            B[state.ind_branch, nread + nc + il] = lp
+        b_dc = sim.b.copy()
+        b_dc[state.cap_branch] = 0
+        b_dc[state.ind_branch] = 0
+        b_dc[state.ac_branch] = 0
+        B[:, ns] = b_dc
+        B[state.ac_branch, ns + 1 + np.arange(nac)] = state.ac_amp
+        X = solver.solve_matrix(B)
+        MX = M @ X
+        RX = sim.probes.matrix(N) @ X
+
+        # cos(w t[n+1]) = cos(wh) cos(w t[n]) - sin(wh) sin(w t[n])
+        theta = state.ac_omega * h
+        rot = np.zeros((nac, nz), dtype=np.float64)
+        rot[np.arange(nac), ns + 1 + np.arange(nac)] = np.cos(theta)
+        rot[np.arange(nac), ns + 1 + nac + np.arange(nac)] = -np.sin(theta)
+
+        def propagate(XX):
+            out = np.zeros((XX.shape[0], nz), dtype=np.float64)
+            out[:, :ns + 1] = XX[:, :ns + 1]
+            out += XX[:, ns + 1:] @ rot
+            return out
+
+        F = np.zeros((nz, nz), dtype=np.float64)
+        F[:nread] = propagate(MX)
+        if nprev:
+            F[nread + ic, ic] = 1
+            F[nread + nc + il, 2 * nc + il] = 1
+        F[ns, ns] = 1
+        k = np.arange(nac)
+        F[ns + 1 + k, ns + 1 + k] = np.cos(theta)
+        F[ns + 1 + k, ns + 1 + nac + k] = -np.sin(theta)
+        F[ns + 1 + nac + k, ns + 1 + k] = np.sin(theta)
+        F[ns + 1 + nac + k, ns + 1 + nac + k] = np.cos(theta)
+        H = propagate(RX)
+
+        ny = len(sim.probes.u)
+        W = np.empty((block, ny, nz), dtype=np.float64)
+        W[0] = H
+        for j in range(1, block):
+            W[j] = W[j - 1] @ F
+        self.W = W.reshape(block * ny, nz)
+        self.FK = np.linalg.matrix_power(F, block)
+        self.block = block
+        self.ny = ny
+
+        z = np.empty(nz, dtype=np.float64)
+        z[:nread] = M @ sim.x
+        if nprev:
+            z[nread:nread + nc] = state.cap_prev
+            z[nread + nc:ns] = state.ind_prev
+        z[ns] = 1
+        z[ns + 1:ns + 1 + nac] = np.cos(state.ac_omega * sim.t)
+        z[ns + 1 + nac:] = np.sin(state.ac_omega * sim.t)
+        self.z = z
+        self.delta_t = h
+        self.t0 = sim.t
+        self.tick = 0
+        self.probes = sim.probes
+        # Probe terms computed but not yet handed out, starting with the
+        # current sample
+        self.pending = self.probes.gather(sim.x)[:, None]
+
+    # Same contract as Simulation.advance
+    def advance(self, tt, ys, t_stop=np.inf):
+        k = 0
+        while k < len(tt):
+            if self.pending.shape[1] == 0:
+                self.pending = (self.W @ self.z).reshape(self.block, self.ny).T
+                self.z = self.FK @ self.z
+            n = min(len(tt) - k, self.pending.shape[1])
+            t = self.t0 + (self.tick + np.arange(n)) * self.delta_t
+            n = np.count_nonzero(t <= t_stop)
+            if n == 0:
+                break
+            tt[k:k + n] = t[:n]
+            self.probes.combine(self.pending[:, :n], ys[:, k:k + n])
+            self.pending = self.pending[:, n:]
+            self.tick += n
+            k += n
+        return k
+
+
+def simulate(netlist, t_stop, delta_t, probes, adaptive=False, reltol=1e-3, abstol=1e-6, method='trap',
+             kernel=False, op=False):
+    if kernel and adaptive:
+        raise ValueError('The state-space kernel needs a fixed step and cannot run adaptively')
+    load(netlist)
+    if op:
+        operating_point()
+    if not adaptive:
+        sim = Simulation(delta_t, probes, method=method)
+        steps = int(round(t_stop / delta_t)) + 1
+        tt = np.empty(steps, dtype=np.float64)
+        ys = np.empty((len(probes), steps), dtype=np.float64)
+        if not kernel:
+            sim.advance(tt, ys)
+            return tt, ys
+        # Gear-2 needs one step of history before it is a fixed linear map
+        k = sim.advance(tt[:1], ys[:, :1]) if method == 'gear2' else 0
+        StateSpace(sim).advance(tt[k:], ys[:, k:])
+        return tt, ys
+
+    sim = Simulation(delta_t, probes, True, reltol, abstol, t_stop / 50, method)
+    chunks = []
+    while sim.t < t_stop or not chunks:
+        tt = np.empty(1024, dtype=np.float64)
+        ys = np.empty((len(probes), 1024), dtype=np.float64)
+        k = sim.advance(tt, ys, t_stop)
+        chunks.append((tt[:k], ys[:, :k]))
+    return np.concatenate([tt for tt, ys in chunks]), np.concatenate([ys for tt, ys in chunks], axis=1)
+
+
+# Fixed-step transient streamed to a waveform file in chunks of `chunk`
+# samples, so memory use does not grow with t_stop
+def record(path, netlist, t_stop, delta_t, probes, method='trap', chunk=65536, op=False):
+    load(netlist)
+    if op:
+        operating_point()
+    sim = Simulation(delta_t, probes, method=method)
+    steps = int(round(t_stop / delta_t)) + 1
+    tt = np.empty(min(chunk, steps), dtype=np.float64)
+    ys = np.empty((len(probes), len(tt)), dtype=np.float64)
+    with WaveformWriter(path, probe_names(probes)) as writer:
+        while steps > 0:
+            k = sim.advance(tt[:steps], ys[:, :steps])
+            writer.append(tt[:k], ys[:, :k])
+            steps -= k
+    return writer.points
+
+
+BATCH_TYPES = ['VS', 'CS', 'AC', 'C', 'L']
+
+
+# Run S scenarios that share the circuit and differ only in source values in
+# lockstep: sources maps component names to S values each (the `val` of a
+# VS, CS, AC source or the initial value of a C or L).  Every step is one
+# factorized solve with an (N, S) right-hand side.  Returns the time axis and
+# an array of shape (probes, S, steps).
+def simulate_batch(netlist, t_stop, delta_t, probes, sources, method='trap', op=False):
+    load(netlist)
+    if len(device_rows(reg)):
+        raise ValueError('Scenarios cannot be run together on a circuit with nonlinear devices')
+    S = len(next(iter(sources.values())))
+    vals = np.repeat(reg.val[:, None], S, axis=1)
+    for name, values in sources.items():
+        row = reg.index(name)
+        if TYPES[reg.type[row]] not in BATCH_TYPES:
+            raise ValueError('\'%s\' is not a source or a C/L initial value' % name)
+        vals[row] = values
+    reg.b = reg.stamps.rhs(vals)
+    if op:
+        operating_point()
+    sim = Simulation(delta_t, probes, method=method)
+    steps = int(round(t_stop / delta_t)) + 1
+    tt = np.empty(steps, dtype=np.float64)
+    ys = np.empty((len(probes), S, steps), dtype=np.float64)
+    sim.advance(tt, ys)
+    return tt, ys
+
+
+# Bytes of complex matrices solved together by the dense AC sweep
+AC_BATCH_BYTES = 64 * 2 ** 20
+
+
+# Small-signal matrices Y(w) = G + jw C of the circuit assembled by solve().
+# The branch row of a capacitor becomes  jwC (x[u] - x[v]) + x[p] = 0  and
+# that of an inductor  jwL x[p] + x[u] - x[v] = 0;  all other rows are shared
+# with the transient matrix.
+def ac_matrices(A, state):
+    A = A.tocoo()
+    nc = len(state.cap_branch)
+    nl = len(state.ind_branch)
+    reactive = np.zeros(A.shape[0], dtype=bool)
+    reactive[state.cap_branch] = True
+    reactive[state.ind_branch] = True
+    keep = ~reactive[A.row]
+    G = sp.csr_matrix((np.concatenate([A.data[keep], np.ones(nc), np.ones(nl), -np.ones(nl)]),
+                       (np.concatenate([A.row[keep], state.cap_branch, state.ind_branch, state.ind_branch]),
+                        np.concatenate([A.col[keep], state.cap_branch, state.ind_u, state.ind_v]))),
+                      shape=A.shape)
+    cap = 1 / state.cap_k
+    C = sp.csr_matrix((np.concatenate([cap, -cap, 1 / state.ind_k]),
+                       (np.concatenate([state.cap_branch, state.cap_branch, state.ind_branch]),
+                        np.concatenate([state.cap_u, state.cap_v, state.ind_branch]))),
+                      shape=A.shape)
+    return G, C
+
+
+# Conductance from every node to ground in the operating point, which keeps
+# nodes that only connect through capacitors from making it singular
+GMIN = 1e-12
+
+
+# DC operating point of the circuit assembled by solve(): capacitors open,
+# inductors shorted and AC sources at zero, which is Y(0) = G of the AC
+# analysis.  Writes the capacitor voltages and inductor currents into reg.b
+# as the initial C/L states, so a Simulation created afterwards starts from
+# steady state, and returns the solution x.  Nonlinear devices are solved by
+# Newton from the solution without them and left linearized at the result.
+def operating_point(devices=None):
+    state = Transient(reg)
+    G, C = ac_matrices(reg.A, state)
+    n = reg.getN()
+    G = G + sp.diags(np.r_[0.0, np.full(n - 1, GMIN), np.zeros(G.shape[0] - n)], format='csr')
+    rhs = np.array(reg.b, dtype=np.float64)
+    rhs[state.cap_branch] = 0
+    rhs[state.ind_branch] = 0
+    rhs[state.ac_branch] = 0
+    x = Solver(G).step_solve(rhs).copy()
+    if devices is None and len(device_rows(reg)):
+        devices = Devices(reg)
+    if devices is not None:
+        x = devices.newton(None, lambda: G, rhs, x)
+    reg.b[state.cap_branch] = x[state.cap_u] - x[state.cap_v]
+    reg.b[state.ind_branch] = x[state.ind_branch]
+    return x
+
+
+# Frequency response at the probes for the frequencies freqs (Hz).  Every AC
+# source is an excitation of its amplitude `val` with zero phase; DC voltage
+# sources are shorted and DC current sources opened.  Nonlinear devices take
+# their small-signal conductances at the DC operating point.  Returns a
+# complex array with one row per probe.
+def ac_analysis(freqs, probes):
+    state = Transient(reg)
+    G, C = ac_matrices(reg.A, state)
+    devices = None
+    if len(device_rows(reg)):
+        devices = Devices(reg, reg.solver.sparse)
+        b = reg.b.copy()
+        operating_point(devices)
+        reg.b[:] = b
+        G = devices.jacobian(G)
+    N = G.shape[0]
+    rhs = np.zeros(N, dtype=np.complex128)
+    rhs[state.ac_branch] = state.ac_amp
+    probes = Probes(probes, reg, devices.small_signal if devices is not None else None)
+    omega = 2 * np.pi * np.asarray(freqs, dtype=np.float64)
+    ys = np.empty((len(probes), len(omega)), dtype=np.complex128)
+
+    if not reg.solver.sparse:
+        G = G.toarray()
+        C = C.toarray()
+        batch = max(AC_BATCH_BYTES // (16 * N * N), 1)
+        for i in range(0, len(omega), batch):
+            Y = G + 1j * omega[i:i + batch, None, None] * C
+            x = np.linalg.solve(Y, np.broadcast_to(rhs[:, None], (len(Y), N, 1)))[..., 0]
+            probes.combine(probes.gather(x.T), ys[:, i:i + batch])
+    else:
+        G = G.astype(np.complex128).tocsc()
+        C = C.astype(np.complex128).tocsc()
+        for i, w in enumerate(omega):
+            x = splu(G + 1j * w * C).solve(rhs)
+            probes.evaluate(x, ys[:, i])
+    return ys
+
+
+def ac_sweep(netlist, f_start, f_stop, points, probes, sweep='dec'):
+    load(netlist)
+    if sweep == 'dec':
+        freqs = np.logspace(np.log10(f_start), np.log10(f_stop), int(round(points * np.log10(f_stop / f_start))) + 1)
+    elif sweep == 'lin':
+        freqs = np.linspace(f_start, f_stop, points)
+    else:
+        raise ValueError('Unknown sweep type \'%s\'' % sweep)
+    return freqs, ac_analysis(freqs, probes)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Headless transient or AC analysis of a Spicy netlist.')
+    parser.add_argument('netlist', nargs='?', default='input.txt', help='text netlist, or binary netlist (.npz)')
+    parser.add_argument('--t-stop', type=float, default=1.0)
+    parser.add_argument('--delta-t', type=float, default=1e-4)
+    parser.add_argument('--probe', type=int, nargs=2, action='append', metavar=('FROM', 'TO'),
+                        help='node pair to record, may be repeated (default: every node to ground)')
+    parser.add_argument('--expr', action='append',
+                        help='probe expression to record such as V(3), I(L1) or V(2)*I(VS1), may be repeated')
+    parser.add_argument('--method', choices=METHODS, default='trap', help='integration method for C and L')
+    # The state-space kernel needs a fixed step
+    stepping = parser.add_mutually_exclusive_group()
+    stepping.add_argument('--kernel', action='store_true',
+                          help='advance a fixed-step linear circuit with the block state-space propagator')
+    stepping.add_argument('--adaptive', action='store_true', help='control the step size by local truncation error')
+    parser.add_argument('--op', action='store_true',
+                        help='start the transient from the DC operating point instead of the netlist C/L values')
+    parser.add_argument('--reltol', type=float, default=1e-3)
+    parser.add_argument('--abstol', type=float, default=1e-6)
+    parser.add_argument('--ac', type=float, nargs=3, metavar=('FSTART', 'FSTOP', 'POINTS'),
+                        help='run an AC sweep with POINTS per decade instead of a transient')
+    parser.add_argument('-o', '--output',
+                        help='write t and probe waveforms to this file instead of stdout: a memory-mapped '
+                             'waveform file if it ends in .raw, an .npz file otherwise')
+    args = parser.parse_args(argv)
+
+    probes = [tuple(probe) for probe in args.probe or []] + (args.expr or [])
+    if not probes:
+        file_input(args.netlist)
+        probes = [(i, 0) for i in range(1, reg.getN())]
+
+    if args.ac:
+        f_start, f_stop, points = args.ac
+        freqs, ys = ac_sweep(args.netlist, f_start, f_stop, int(points), probes)
+        if args.output:
+            np.savez(args.output, f=freqs, y=ys, probes=np.array(probe_names(probes)))
+        else:
+            header = ','.join(['f'] + ['|%s|,arg %s' % (name, name) for name in probe_names(probes)])
+            cols = [freqs]
+            for y in ys:
+                cols += [np.abs(y), np.degrees(np.angle(y))]
+            np.savetxt(sys.stdout, np.vstack(cols).T, fmt='%.17g', delimiter=',', header=header, comments='')
+        return
+
+    raw = args.output is not None and args.output.endswith('.raw')
+    tic = time.time()
+    if raw and not args.adaptive and not args.kernel:
+        points = record(args.output, args.netlist, args.t_stop, args.delta_t, probes, args.method, op=args.op)
+        print('%d iterations in %.2f sec' % (points, time.time() - tic), file=sys.stderr)
+        return
+    tt, ys = simulate(args.netlist, args.t_stop, args.delta_t, probes, args.adaptive, args.reltol, args.abstol,
+                      args.method, args.kernel, args.op)
+    toc = time.time()
+    print('%d iterations in %.2f sec' % (len(tt), toc - tic), file=sys.stderr)
+
+    if raw:
+        with WaveformWriter(args.output, probe_names(probes)) as writer:
+            writer.append(tt, ys)
+    elif args.output:
+        np.savez(args.output, t=tt, y=ys, probes=np.array(probe_names(probes)))
+    else:
+        header = ','.join(['t'] + probe_names(probes))
+        np.savetxt(sys.stdout, np.vstack([tt, ys]).T, fmt='%.17g', delimiter=',', header=header, comments='')
 
 
 if __name__ == '__main__':
-    main()
+    # Bad input and circuits that cannot be solved end with their message;
+    # NetlistError and LinAlgError are ValueErrors
+    try:
+        main()
+    except (ValueError, OSError, np.linalg.LinAlgError, ConvergenceError) as e:
+        sys.exit(str(e))
@@ -2,11 +2,12 @@
 import sys
 from collections import namedtuple
 from PyQt5 import QtCore, QtWidgets, QtGui
-from PyQt5.QtCore import pyqtSignal, QObject, Qt
+from PyQt5.QtCore import pyqtSignal, QObject, Qt, QAbstractTableModel
 from PyQt5.QtWidgets import QMenu, QAction, QMessageBox, QGridLayout, QGroupBox, QTableView, QWidget, \
     QVBoxLayout, QComboBox, QHBoxLayout, QLabel, QPushButton, QSpinBox, QDoubleSpinBox, QTableWidget, QTableWidgetItem, \
-    QHeaderView, QApplication
+    QHeaderView, QApplication, QLineEdit, QCheckBox, QFileDialog
 import os
+import threading
 import time
 import numpy as np
 import matplotlib
@@ -14,6 +15,8 @@ import matplotlib.pylab as mp
 from matplotlib import pyplot as plt
 import matplotlib.animation as ma
 import solver_12_11
+from scope import Scope
+from waveform import WaveformWriter
 matplotlib.use('Qt5Agg')
 
 class Component(namedtuple('Component', ['type', 'nid', 'u', 'v', 'val', 'factor', 'ref_u', 'ref_v', 'ref_comp'])):
@@ -23,6 +26,10 @@ class Component(namedtuple('Component', ['type', 'nid', 'u', 'v', 'val', 'factor
 class Displaynode(namedtuple('Displaynode', ['from_node', 'to_node'])):
     pass
 
+# 探针表达式, 如 I(L1) 或 V(2)*I(VS1)
+class Displayexpr(namedtuple('Displayexpr', ['expr'])):
+    pass
+
 class ComponentRegistry(QObject):
     updated = pyqtSignal()
 
@@ -45,7 +52,33 @@ class ComponentRegistry(QObject):
         self.updated.emit()
         return True
 
-    def add_display_node(self, displaynode: Displaynode):
+    # 批量载入: 替换全部元件, 期间不发 updated 信号, 最后只刷新一次.
+    # 检测点属于原来的电路, 一并清空
+    def load_components(self, comps):
+        self.blockSignals(True)
+        try:
+            self.comps = []
+            self.name_to_comps = {}
+            self.display_node = []
+            for comp in comps:
+                self.add_component(comp)
+        finally:
+            self.blockSignals(False)
+        self.updated.emit()
+
+    # 替换同名元件, 保持其在网表中的位置
+    def replace_component(self, comp: Component):
+        name = comp.type + str(comp.nid)
+        if not self.has_component(name):
+            return False
+
+        old = self.name_to_comps[name]
+        self.comps[next(i for i, c in enumerate(self.comps) if c is old)] = comp
+        self.name_to_comps[name] = comp
+        self.updated.emit()
+        return True
+
+    def add_display_node(self, displaynode):
         self.display_node.append(displaynode)
         self.updated.emit()
         return True
@@ -61,8 +94,148 @@ class ComponentRegistry(QObject):
         return True
 
 
+# 网表表格的数据模型: 单元格文本按需从 reg.comps 生成, 注册表变化时只重置模型,
+# 视图只查询可见的行
+class NetlistModel(QAbstractTableModel):
+    HEADERS = ["元件名称", "起始节点", "终止节点", "参数", "特征系数"]
+
+    def __init__(self, registry, parent=None):
+        QAbstractTableModel.__init__(self, parent)
+        self.registry = registry
+        registry.updated.connect(self.refresh)
+
+    def refresh(self):
+        self.beginResetModel()
+        self.endResetModel()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.registry.comps)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return self.HEADERS[section]
+        return str(section + 1)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        return self.text(index.row(), index.column())
+
+    # 第 row 行第 column 列的文本, 无内容时为 None
+    def text(self, row, column):
+        comp = self.registry.comps[row]
+        if column == 0:
+            return comp.type + str(comp.nid)
+        if column == 1:
+            return str(comp.u)
+        if column == 2:
+            return str(comp.v)
+        if comp.type in ["VCVS", "VCCS"]:
+            cells = ['%f %d %d' % (comp.val, comp.ref_u, comp.ref_v)]
+        elif comp.type in ["CCVS", "CCCS"]:
+            cells = ['%f %s' % (comp.val, comp.ref_comp)]
+        elif comp.type in ["C", "L", "AC"]:
+            cells = ['%f' % comp.val, '%f' % comp.factor]
+        elif comp.type in ["D"]:
+            cells = [str(comp.val), str(comp.factor)]
+        elif comp.type in ["M"]:
+            cells = ['%s %d' % (comp.val, comp.ref_u), str(comp.factor)]
+        elif comp.type in ["SW"]:
+            cells = ['%s %d %d' % (comp.val, comp.ref_u, comp.ref_v), str(comp.factor)]
+        else:
+            cells = [str(comp.val)]
+        return cells[column - 3] if column - 3 < len(cells) else None
+
+
+# GUI 元件表转换为求解器的列式网表; 元件类型用不到的参考节点按解析器的约定填写
+def to_netlist(comps):
+    comps = list(comps)
+
+    def column(values, dtype):
+        return np.array(list(values), dtype=dtype)
+
+    def ref_node(comp, field):
+        if field in solver_12_11.WRITE_FIELDS[comp.type]:
+            return getattr(comp, field)
+        return comp.v if comp.type == "M" and field == 'ref_v' else 0
+
+    return solver_12_11.Netlist(
+        column((solver_12_11.TYPE_CODE[comp.type] for comp in comps), np.int8),
+        column((comp.nid for comp in comps), np.int64),
+        column((comp.u for comp in comps), np.int64),
+        column((comp.v for comp in comps), np.int64),
+        column((comp.val for comp in comps), np.float64),
+        column((comp.factor for comp in comps), np.float64),
+        column((ref_node(comp, 'ref_u') for comp in comps), np.int64),
+        column((ref_node(comp, 'ref_v') for comp in comps), np.int64),
+        column((solver_12_11.name_key(comp.ref_comp) if comp.type in ["CCVS", "CCCS"] else -1 for comp in comps),
+               np.int64),
+        None)
+
+
+class SimulationWorker(QObject):
+    chunk = pyqtSignal(object, object)
+    failed = pyqtSignal(str)
+    finished = pyqtSignal()
+
+    # Wall-clock budget of one batch of steps, so that stop/pause requests are
+    # honoured within a few milliseconds whatever the circuit size.
+    CHUNK_SECONDS = 0.01
+
+    def __init__(self, delta_t, probes, op=False):
+        QObject.__init__(self)
+        self.delta_t = delta_t
+        self.probes = probes
+        self.op = op
+        self.running = True
+        self.resumed = threading.Event()
+        self.resumed.set()
+
+    def run(self):
+        try:
+            solver_12_11.load('input.txt')
+            if self.op:
+                solver_12_11.operating_point()
+            sim = solver_12_11.Simulation(self.delta_t, self.probes)
+            steps = 16
+            while self.running:
+                self.resumed.wait()
+                if not self.running:
+                    break
+                tt = np.empty(steps, dtype=np.float64)
+                ys = np.empty((len(self.probes), steps), dtype=np.float64)
+                tic = time.perf_counter()
+                sim.advance(tt, ys)
+                elapsed = time.perf_counter() - tic
+                self.chunk.emit(tt, ys)
+                steps = int(min(max(steps * self.CHUNK_SECONDS / max(elapsed, 1e-6), 1), 4 * steps + 1))
+        except Exception as e:
+            self.failed.emit(str(e))
+        self.finished.emit()
+
+    def pause(self):
+        self.resumed.clear()
+
+    def resume(self):
+        self.resumed.set()
+
+    def stop(self):
+        self.running = False
+        self.resumed.set()
+
+
 reg = ComponentRegistry()
 
+# 示波器一屏保留的采样点数
+SCOPE_SAMPLES = 20000
+# 完整波形写入此文件, 可用 waveform.read_waveform 读取
+WAVEFORM_FILE = 'waveform.raw'
+
 
 class MainWindow(QtWidgets.QMainWindow):
     def __init__(self, parent=None):
@@ -78,11 +251,14 @@ class MainWindow(QtWidgets.QMainWindow):
         self.menu_file = QMenu("文件")
         self.menu_file_open = QAction("打开", self.menu_file)
         self.menu_file_save = QAction("保存", self.menu_file)
+        self.menu_file_save_as = QAction("另存为", self.menu_file)
         self.menu_exit = QAction("退出", self.menu_file)
-        self.menu_file.addActions([self.menu_file_open, self.menu_file_save, self.menu_exit])
+        self.menu_file.addActions([self.menu_file_open, self.menu_file_save, self.menu_file_save_as, self.menu_exit])
         self.menuBar().addMenu(self.menu_file)
         self.menu_exit.triggered.connect(lambda: QApplication.instance().exit(0))
+        self.menu_file_open.triggered.connect(self.open)
         self.menu_file_save.triggered.connect(self.save)
+        self.menu_file_save_as.triggered.connect(self.save_as)
 
         # About Menu
         self.menu_help = QMenu("帮助")
@@ -95,16 +271,16 @@ class MainWindow(QtWidgets.QMainWindow):
         # - Netlist View
         self.netlist_group = QGroupBox("网表")
         layout = QGridLayout()
-        self.netlist_view = QTableWidget()
-        self.netlist_view.setColumnCount(5)
-        self.netlist_view.setHorizontalHeaderLabels(["元件名称", "起始节点", "终止节点", "参数",  "特征系数"])
+        self.netlist_model = NetlistModel(reg, self)
+        self.netlist_view = QTableView()
+        self.netlist_view.setModel(self.netlist_model)
         self.netlist_view.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
         self.netlist_view.horizontalHeader().setVisible(True)
         self.netlist_view.verticalHeader().setVisible(True)
-        self.netlist_view.setEditTriggers(QtWidgets.QTableWidget.NoEditTriggers)
+        self.netlist_view.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.netlist_view.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
         layout.addWidget(self.netlist_view, 1, 1, 1, 1)
         self.netlist_group.setLayout(layout)
-        reg.updated.connect(self.update_netlist)
 
         # - Display nodes view
         self.displayshow_group = QGroupBox("示波器展示节点")
@@ -149,6 +325,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.edit_ref_to = QSpinBox()
         self.edit_ref_comp = QComboBox()
         self.edit_add = QPushButton("添加")
+        self.edit_modify = QPushButton("修改")
         layout_labels.addWidget(QLabel("元件类型"))
         layout_inputs.addWidget(self.edit_type)
         layout_labels.addWidget(QLabel("元件编号"))
@@ -168,20 +345,28 @@ class MainWindow(QtWidgets.QMainWindow):
         layout_labels.addWidget(QLabel("参考元件"))
         layout_inputs.addWidget(self.edit_ref_comp)
         layout_actions.addWidget(self.edit_add)
+        layout_actions.addWidget(self.edit_modify)
         self.edit_group.setLayout(layout)
         self.type_changed()
         self.edit_add.clicked.connect(self.add_component)
+        self.edit_modify.clicked.connect(self.modify_component)
         reg.updated.connect(self.update_ref_comp)
 
         # - Control View
         self.control_group = QGroupBox("控制")
         layout = QVBoxLayout()
         self.control_start = QPushButton("启动仿真")
+        self.control_pause = QPushButton("暂停仿真")
         self.control_stop = QPushButton("停止仿真")
+        # 勾选时先求直流工作点, 电容电压和电感电流从稳态开始
+        self.control_op = QCheckBox("从直流工作点开始")
         layout.addWidget(self.control_start)
+        layout.addWidget(self.control_pause)
         layout.addWidget(self.control_stop)
+        layout.addWidget(self.control_op)
         self.control_group.setLayout(layout)
         self.control_start.clicked.connect(self.start)
+        self.control_pause.clicked.connect(self.pause)
         self.control_stop.clicked.connect(self.stop)
 
         # - Display View
@@ -196,13 +381,20 @@ class MainWindow(QtWidgets.QMainWindow):
         self.display_from = QSpinBox()
         self.display_to = QSpinBox()
         self.display_add = QPushButton("添加")
+        self.display_expr = QLineEdit()
+        self.display_expr.setPlaceholderText("V(2)*I(VS1)")
+        self.display_add_expr = QPushButton("添加表达式")
         layout_labels.addWidget(QLabel("正极节点数"))
         layout_inputs.addWidget(self.display_from)
         layout_labels.addWidget(QLabel("负极节点数"))
         layout_inputs.addWidget(self.display_to)
+        layout_labels.addWidget(QLabel("探针表达式"))
+        layout_inputs.addWidget(self.display_expr)
         layout_actions.addWidget(self.display_add)
+        layout_actions.addWidget(self.display_add_expr)
         self.display_group.setLayout(layout)
         self.display_add.clicked.connect(self.add_display_node)
+        self.display_add_expr.clicked.connect(self.add_display_expr)
 
         self.grid = QGridLayout()
         self.grid.addWidget(self.netlist_group, 1, 1, 2, 5)
@@ -214,6 +406,11 @@ class MainWindow(QtWidgets.QMainWindow):
 
         # Status
         self.running = False
+        self.worker = None
+        self.worker_thread = None
+        self.plot_timer = QtCore.QTimer(self)
+        self.plot_timer.setInterval(50)
+        self.plot_timer.timeout.connect(self.redraw)
 
     def about(self):
         QMessageBox.about(self, "关于 Spicy", "Spicy 是一个简单的瞬态电路仿真器")
@@ -248,94 +445,128 @@ class MainWindow(QtWidgets.QMainWindow):
         else:
             print("ERROR: Unrecognized component type [%s]" % comp_type, file=sys.stderr)
 
-    def update_netlist(self):
-        self.netlist_view.setRowCount(0)
-        self.netlist_view.setRowCount(len(reg.comps))
-        for i, comp in enumerate(reg.comps):
-            name = comp.type + str(comp.nid)
-            self.netlist_view.setItem(i, 0, QTableWidgetItem(name))
-            self.netlist_view.setItem(i, 1, QTableWidgetItem(str(comp.u)))
-            self.netlist_view.setItem(i, 2, QTableWidgetItem(str(comp.v)))
-
-            if comp.type in ["VCVS", "VCCS"]:
-                self.netlist_view.setItem(i, 3, QTableWidgetItem('%f %d %d' % (comp.val, comp.ref_u, comp.ref_v)))
-            elif comp.type in ["CCVS", "CCCS"]:
-                self.netlist_view.setItem(i, 3, QTableWidgetItem('%f %s' % (comp.val, comp.ref_comp)))
-            elif comp.type in ["C", "L"]:
-                self.netlist_view.setItem(i, 3, QTableWidgetItem('%f' % comp.val))
-                self.netlist_view.setItem(i, 4, QTableWidgetItem('%f' % comp.factor))
-            elif comp.type in ["AC"]:
-                self.netlist_view.setItem(i, 3, QTableWidgetItem('%f' % comp.val))
-                self.netlist_view.setItem(i, 4, QTableWidgetItem('%f' % comp.factor))
-            else:
-                self.netlist_view.setItem(i, 3, QTableWidgetItem(str(comp.val)))
-
     def update_displaynode(self):
         self.displayshow_view.setRowCount(0)
+        self.displayshow_view.clearSpans()
         self.displayshow_view.setRowCount(len(reg.display_node))
         for i, displaynode in enumerate(reg.display_node):
+            if isinstance(displaynode, Displayexpr):
+                self.displayshow_view.setItem(i, 0, QTableWidgetItem(displaynode.expr))
+                self.displayshow_view.setSpan(i, 0, 1, 2)
+                continue
             self.displayshow_view.setItem(i, 0, QTableWidgetItem(str(displaynode.from_node)))
             self.displayshow_view.setItem(i, 1, QTableWidgetItem(str(displaynode.to_node)))
 
+    # 读入网表文件, 替换当前网表
+    def open(self):
+        name, _ = QFileDialog.getOpenFileName(self, "打开", "", "网表 (*.txt *.npz);;所有文件 (*)")
+        if not name:
+            return
+        try:
+            netlist = solver_12_11.read_netlist(name)
+        except (OSError, solver_12_11.NetlistError) as e:
+            QMessageBox.critical(self, "错误", "无法打开网表: %s" % e)
+            return
+
+        types = [solver_12_11.TYPES[code] for code in netlist.type.tolist()]
+        refs = [solver_12_11.key_name(key) if key >= 0 else '' for key in netlist.ref.tolist()]
+        reg.load_components(map(Component, types, netlist.nid.tolist(), netlist.u.tolist(), netlist.v.tolist(),
+                                netlist.val.tolist(), netlist.factor.tolist(), netlist.ref_u.tolist(),
+                                netlist.ref_v.tolist(), refs))
+
+    # 网表直接从注册表写出, 数值按 repr 保存, 不损失精度
+    def write(self, name):
+        try:
+            solver_12_11.write_netlist(name, to_netlist(reg.comps))
+        except KeyError as e:
+            QMessageBox.critical(self, "错误", "参考元件 %s 无效" % e)
+        except OSError as e:
+            QMessageBox.critical(self, "错误", "无法保存网表: %s" % e)
+
     def save(self):
         if len(reg.display_node) != 0:
-            with open('input.txt', 'w') as f:
-                for i in range(0, len(reg.comps), 1):
-                    for j in range(0, 5, 1):
-                        if self.netlist_view.item(i, j):
-                            f.write(self.netlist_view.item(i, j).text())
-                            f.write(' ')
-                    f.write('\n')
-            f.close()
+            self.write('input.txt')
         else:
             QMessageBox.critical(self, "错误", "请输入示波器检测点")
 
+    # 以 .npz 结尾时保存为压缩的二进制网表
+    def save_as(self):
+        name, selected = QFileDialog.getSaveFileName(self, "另存为", "", "网表 (*.txt);;二进制网表 (*.npz)")
+        if not name:
+            return
+        if selected.endswith("(*.npz)") and not name.endswith(".npz"):
+            name += ".npz"
+        self.write(name)
+
     def start(self):
-        # 这里加入求逆和b的内容
-        solver_12_11.file_input('input.txt')
-        solver_12_11.solve()
-        t = 0
-        delta_t = 1e-4
-        tt = []
-        seq_list = [[] for i in range(0, len(reg.display_node), 1)]
-        plt.figure(figsize=(6, 4))
-        legends = []
-        for disp in reg.display_node:
-            plt.plot([], [])
-            legends.append('node %d to %d' % (disp.from_node, disp.to_node))
-        plt.legend(legends)
-        plt.pause(0.001)
-        tick = 0
+        if self.running:
+            return
+        self.delta_t = 1e-4
+        legends = [disp.expr if isinstance(disp, Displayexpr) else 'node %d to %d' % (disp.from_node, disp.to_node)
+                   for disp in reg.display_node]
+        self.figure = plt.figure(figsize=(6, 4))
+        self.scope = Scope(self.figure, legends, SCOPE_SAMPLES * self.delta_t, SCOPE_SAMPLES)
+        self.figure.show()
+
+        # 仿真在工作线程中运行, 结果按块通过信号送回界面线程
+        probes = [disp.expr if isinstance(disp, Displayexpr) else (disp.from_node, disp.to_node)
+                  for disp in reg.display_node]
+        self.writer = WaveformWriter(WAVEFORM_FILE, solver_12_11.probe_names(probes))
+        self.worker = SimulationWorker(self.delta_t, probes, self.control_op.isChecked())
+        self.worker_thread = QtCore.QThread()
+        self.worker.moveToThread(self.worker_thread)
+        self.worker_thread.started.connect(self.worker.run)
+        self.worker.chunk.connect(self.receive_chunk)
+        self.worker.failed.connect(lambda msg: QMessageBox.critical(self, "错误", "仿真失败: %s" % msg))
+        # quit 直接在工作线程中调用: QThread 对象属于界面线程, 排队调用在界面线程阻塞于 wait() 时永远不会执行
+        self.worker.finished.connect(self.worker_thread.quit, Qt.DirectConnection)
+        self.worker.finished.connect(self.finished)
         self.running = True
-        while self.running:
-            x = solver_12_11.reg.inv_A.dot(solver_12_11.reg.b)
-            tt.append(t)
-            for i, disp in enumerate(reg.display_node):
-                seq_list[i].append(x[disp.from_node] - x[disp.to_node])
-            if tick % 1000 == 0:
-                plt.clf()
-                for i, disp in enumerate(reg.display_node):
-                    plt.plot(tt, seq_list[i])
-                plt.title('time = %f' % t)
-                plt.legend(legends)
-                plt.pause(0.001)
-                print(tick)
-            for comp in solver_12_11.reg.comps:
-                name = comp.type + str(comp.nid)
-                if comp.type == 'C':
-                    comp.val += -x[solver_12_11.reg.current_note[name]] / comp.factor * delta_t
-                    solver_12_11.reg.b[solver_12_11.reg.dynamic_place[name]] = comp.val
-                elif comp.type == 'L':
-                    comp.val += (x[comp.v] - x[comp.u]) / comp.factor * delta_t
-                    solver_12_11.reg.b[solver_12_11.reg.dynamic_place[name]] = comp.val
-                elif comp.type == 'AC':
-                    solver_12_11.reg.b[solver_12_11.reg.dynamic_place[name]] = np.cos(comp.factor * t) * comp.val
-            t += delta_t
-            tick += 1
-        plt.show()
+        self.control_pause.setText("暂停仿真")
+        self.worker_thread.start()
+        self.plot_timer.start()
 
-    def stop(self):
+    def receive_chunk(self, tt, ys):
+        if self.worker is None:
+            return
+        self.scope.append(tt, ys)
+        self.writer.append(tt, ys)
+
+    def redraw(self):
+        self.scope.redraw()
+
+    def finished(self):
+        if self.worker is None:
+            return
         self.running = False
+        self.plot_timer.stop()
+        self.redraw()
+        self.writer.close()
+        self.worker_thread.wait()
+        self.worker = None
+        self.worker_thread = None
+
+    def pause(self):
+        if not self.running:
+            return
+        if self.worker.resumed.is_set():
+            self.worker.pause()
+            self.control_pause.setText("继续仿真")
+        else:
+            self.worker.resume()
+            self.control_pause.setText("暂停仿真")
+
+    def stop(self):
+        if self.worker is not None:
+            self.worker.stop()
+
+    def closeEvent(self, event):
+        self.stop()
+        if self.worker_thread is not None:
+            self.worker_thread.quit()
+            self.worker_thread.wait()
+            self.finished()
+        super(MainWindow, self).closeEvent(event)
 
     def add_display_node(self):
         from_node = self.display_from.value()
@@ -343,6 +574,13 @@ class MainWindow(QtWidgets.QMainWindow):
         displaynode = Displaynode(from_node, to_node)
         reg.add_display_node(displaynode)
 
+    def add_display_expr(self):
+        expr = self.display_expr.text().strip()
+        if not expr:
+            return
+        reg.add_display_node(Displayexpr(expr))
+        self.display_expr.clear()
+
     def add_component(self):
         _type = self.edit_type.currentText()
         nid = self.edit_nid.value()
@@ -363,6 +601,17 @@ class MainWindow(QtWidgets.QMainWindow):
 
         reg.add_component(comp)
 
+    # 只修改已有元件的参数和特征系数; 保存后重新启动仿真时, 求解器只更新受影响的矩阵元素,
+    # 不重新组装和分解整个矩阵
+    def modify_component(self):
+        name = self.edit_type.currentText() + str(self.edit_nid.value())
+        if not reg.has_component(name):
+            QMessageBox.critical(self, "错误", "元件 %s 不存在" % name)
+            return
+
+        comp = reg.name_to_comps[name]
+        reg.replace_component(comp._replace(val=self.edit_value.value(), factor=self.edit_factor.value()))
+
     def update_ref_comp(self):
         names = reg.name_to_comps.keys()
         self.edit_ref_comp.clear()
@@ -0,0 +1,124 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import solver_12_11
+from solver_12_11 import reg
+
+# Per-process state of a sweep: the netlist is parsed, assembled and
+# factorized once per worker; each run then only recomputes the matrix
+# entries of the elements it changes and carries the factorizations of A
+# and of the step matrix over by solver_12_11.update(), which is a low-rank
+# correction for a few changed elements and otherwise a numeric
+# refactorization with the column order found the first time.
+_job = None
+
+
+def _init(netlist, t_stop, delta_t, probes, method):
+    global _job
+    solver_12_11.load(netlist)
+    _job = {
+        'steps': int(round(t_stop / delta_t)) + 1,
+        'delta_t': delta_t,
+        'probes': probes,
+        'method': method,
+        'nominal': {field: getattr(reg, field).copy() for field in ['val', 'factor']},
+        'rows': np.empty(0, dtype=np.int64),
+    }
+
+
+# Parameter keys are component names ('R1' sets R1.val) or a name with a
+# field ('C1.factor')
+def _split(key):
+    name, _, field = key.partition('.')
+    return name, field or 'val'
+
+
+# Set the values of one run; returns the rows it sets
+def _apply(values):
+    for field, nominal in _job['nominal'].items():
+        getattr(reg, field)[:] = nominal
+    rows = []
+    for key, value in values.items():
+        name, field = _split(key)
+        rows.append(reg.index(name))
+        getattr(reg, field)[rows[-1]] = value
+    return np.array(rows, dtype=np.int64)
+
+
+def _run(values):
+    rows = _apply(values)
+    # The previous run's rows are back at their nominal values
+    solver_12_11.update(np.concatenate([_job['rows'], rows]))
+    _job['rows'] = rows
+    sim = solver_12_11.Simulation(_job['delta_t'], _job['probes'], method=_job['method'])
+    tt = np.empty(_job['steps'], dtype=np.float64)
+    ys = np.empty((len(_job['probes']), _job['steps']), dtype=np.float64)
+    sim.advance(tt, ys)
+    return ys
+
+
+# Runs that only change source values or C/L initial values of a linear
+# circuit share one matrix and are advanced together as columns of one
+# right-hand side
+def _batchable(netlist, runs):
+    solver_12_11.file_input(netlist)
+    if len(solver_12_11.device_rows(reg)):
+        return False
+    for values in runs:
+        for key in values:
+            name, field = _split(key)
+            if field != 'val' or solver_12_11.TYPES[reg.type[reg.index(name)]] not in solver_12_11.BATCH_TYPES:
+                return False
+    return bool(runs) and bool(runs[0]) and all(values.keys() == runs[0].keys() for values in runs)
+
+
+# Run one transient per entry of runs (a dict of parameter values each) in a
+# process pool.  Returns the time axis and an array of shape
+# (probes, runs, steps), so ys[i] stacks every run of probe i.
+def sweep(netlist, runs, t_stop, delta_t, probes, method='trap', workers=None):
+    runs = list(runs)
+    if _batchable(netlist, runs):
+        sources = {key: [values[key] for values in runs] for key in runs[0]}
+        return solver_12_11.simulate_batch(netlist, t_stop, delta_t, probes, sources, method)
+    workers = workers or os.cpu_count() or 1
+    steps = int(round(t_stop / delta_t)) + 1
+    ys = np.empty((len(probes), len(runs), steps), dtype=np.float64)
+    if workers == 1:
+        _init(netlist, t_stop, delta_t, probes, method)
+        results = map(_run, runs)
+    else:
+        pool = ProcessPoolExecutor(workers, initializer=_init, initargs=(netlist, t_stop, delta_t, probes, method))
+        results = pool.map(_run, runs, chunksize=max(len(runs) // (4 * workers), 1))
+    try:
+        for k, y in enumerate(results):
+            ys[:, k] = y
+    finally:
+        if workers != 1:
+            pool.shutdown()
+    return np.arange(steps) * delta_t, ys
+
+
+# Monte-Carlo analysis: every key of tolerances (as in sweep) is varied
+# around its netlist value by the given relative tolerance, either as a
+# Gaussian with the tolerance at 3 sigma or uniformly within +-tolerance.
+# Returns the time axis, the stacked waveforms and the sampled runs.
+def monte_carlo(netlist, tolerances, runs, t_stop, delta_t, probes, distribution='gauss', seed=None,
+                method='trap', workers=None):
+    solver_12_11.file_input(netlist)
+    rng = np.random.default_rng(seed)
+    samples = {}
+    for key, tol in tolerances.items():
+        name, field = _split(key)
+        nominal = getattr(reg, field)[reg.index(name)]
+        if distribution == 'gauss':
+            dev = rng.standard_normal(runs) * tol / 3
+        elif distribution == 'uniform':
+            dev = rng.uniform(-tol, tol, runs)
+        else:
+            raise ValueError('Unknown distribution \'%s\'' % distribution)
+        samples[key] = nominal * (1 + dev)
+    values = [{key: samples[key][k] for key in samples} for k in range(runs)]
+    tt, ys = sweep(netlist, values, t_stop, delta_t, probes, method, workers)
+    return tt, ys, values
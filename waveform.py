@@ -0,0 +1,70 @@
+import json
+import os
+
+import numpy as np
+
+MAGIC = b'SPICYWAV'
+VERSION = 1
+ALIGN = 64
+
+
+# Waveform file: MAGIC, a 4-byte little-endian header length, a JSON header
+# naming the columns (padded so that the data starts on a 64-byte boundary),
+# then one float64 record per time point holding t followed by every probe,
+# as in a SPICE raw file.  Records are only ever appended, so the number of
+# points follows from the file size and a run that is cut short still leaves
+# a readable file.
+class WaveformWriter:
+    def __init__(self, path, names):
+        self.names = list(names)
+        self.points = 0
+        header = json.dumps({'version': VERSION, 'dtype': '<f8', 'columns': ['t'] + self.names}).encode()
+        size = -(-(len(MAGIC) + 4 + len(header)) // ALIGN) * ALIGN - len(MAGIC) - 4
+        self.f = open(path, 'wb')
+        self.f.write(MAGIC + size.to_bytes(4, 'little') + header.ljust(size))
+        self.records = np.empty((0, 1 + len(self.names)), dtype='<f8')
+
+    # Append samples at times tt; ys has one row per probe
+    def append(self, tt, ys):
+        if len(self.records) < len(tt):
+            self.records = np.empty((len(tt), 1 + len(self.names)), dtype='<f8')
+        records = self.records[:len(tt)]
+        records[:, 0] = tt
+        records[:, 1:] = np.transpose(ys)
+        records.tofile(self.f)
+        self.points += len(tt)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Map a waveform file without reading it.  Returns the time axis, the probe
+# samples as a (probes, points) array and the probe names; both arrays are
+# read-only views of one memory map, so only the pages that are touched are
+# ever loaded.
+def read_waveform(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('\'%s\' is not a waveform file' % path)
+        size = int.from_bytes(f.read(4), 'little')
+        header = json.loads(f.read(size))
+        total = os.fstat(f.fileno()).st_size
+    if header['version'] != VERSION:
+        raise ValueError('Unsupported waveform file version %d' % header['version'])
+    columns = header['columns']
+    offset = len(MAGIC) + 4 + size
+    points = (total - offset) // (np.dtype(header['dtype']).itemsize * len(columns))
+    if points == 0:
+        data = np.empty((0, len(columns)), dtype=header['dtype'])
+    else:
+        data = np.memmap(path, dtype=header['dtype'], mode='r', offset=offset, shape=(points, len(columns)))
+    return data[:, 0], data[:, 1:].T, columns[1:]